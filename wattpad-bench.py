@@ -0,0 +1,643 @@
+import argparse
+import base64
+import glob
+import hashlib
+import importlib.util
+import json
+import os
+import posixpath
+import random
+import re
+import resource
+import shlex
+import shutil
+import subprocess
+import socket
+import statistics
+import struct
+import sys
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+import zipfile
+import zlib
+from functools import lru_cache
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import urllib.parse
+
+import requests
+
+def load_downloader():
+    """Загружает wattpad-download.py как модуль (имя файла содержит дефис)."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wattpad-download.py')
+    spec = importlib.util.spec_from_file_location('wattpad_download', path)
+    module = importlib.util.module_from_spec(spec)
+    # Регистрация в sys.modules нужна, чтобы функции модуля передавались в пул процессов
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+wd = load_downloader()
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1, чтобы клиент мог переиспользовать соединения
+    protocol_version = 'HTTP/1.1'
+    payload = b'x' * 16384
+
+    def setup(self):
+        super().setup()
+        # Без Nagle заголовки и тело не ждут delayed ACK на keep-alive соединении
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        self.send_body(self.payload)
+
+    def send_body(self, body, content_type='text/html; charset=utf-8', status=200, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def measure(fetch, urls, workers):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(fetch, urls):
+            pass
+    elapsed = time.perf_counter() - start
+    return len(urls) / elapsed
+
+def bench_http(args):
+    server, base_url = start_server(StandInHandler)
+    urls = [f"{base_url}/page/{i}" for i in range(args.requests)]
+    wd.configure_session(pool_size=args.workers)
+    # Сравнивается только пул соединений: ограничение частоты не должно влиять на замер
+    wd.configure_rate_limit(0, args.workers)
+
+    def bare_get(url):
+        # Старый путь: новое соединение на каждый запрос
+        response = requests.get(url, headers=wd.HTTP_HEADERS, timeout=wd.HTTP_TIMEOUT)
+        response.raise_for_status()
+        return response.content
+
+    def pooled_get(url):
+        return wd.http_get(url).content
+
+    print(f"Запросов: {args.requests}, потоков: {args.workers}")
+    for name, fetch in (('requests.get', bare_get), ('общая сессия', pooled_get)):
+        rps = measure(fetch, urls, args.workers)
+        print(f"{name:>14}: {rps:8.1f} запросов/с")
+    server.shutdown()
+
+WORDS = "лес река город ночь свет ветер дорога окно письмо голос тишина утро".split()
+
+def synthetic_text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+def synthetic_story_html(chapter_count, base_url=''):
+    """Страница истории с разметкой, которую ожидают extract_story_metadata и parse_chapter_list."""
+    toc = ''.join(
+        f'<li><a href="{base_url}/{100000 + i}-chapter-{i}" class="_6qJpE"><div class="wpYp-">Глава {i}</div>'
+        f'<div class="bSGSB">1 янв. 2025 г.</div></a></li>'
+        for i in range(1, chapter_count + 1))
+    return f"""<!DOCTYPE html><html><head><meta charset="utf-8"><title>История</title></head><body>
+<div class="coverWrapper__t2Ve8"><img class="cover__BlyZa" src="{base_url}/img/cover.png" alt="cover"></div>
+<div class="gF-N5">Синтетическая история &amp; тест</div>
+<a href="/user/synthetic_author" class="SjGa2">synthetic_author</a>
+<ul class="n0iXe"><li class="_0jt-y"><div data-tip="1,234,567 прочтений">1.2M</div></li>
+<li class="_0jt-y"><div data-tip="45,678 голосов">45K</div></li><li class="_0jt-y"><div data-tip="{chapter_count} частей">{chapter_count}</div></li></ul>
+<div class="glL-c"><pre class="mpshL _6pPkw">Описание <b>истории</b>\nв две строки<div class="DxZKg">© Все права защищены</div></pre></div>
+<div class="F8LJw"><a class="XZbAz" href="/stories/a"><span class="typography-label-small-semi">приключения</span></a>
+<a class="XZbAz" href="/stories/b"><span class="typography-label-small-semi">фэнтези</span></a></div>
+<div data-testid="toc"><ul>{toc}</ul></div></body></html>"""
+
+def synthetic_chapter_blocks(index, paragraphs, words, images, base_url, image_block, seed=0, page=1):
+    """Абзацы страницы главы; image_block(src, alt, pid) задаёт разметку изображения."""
+    rng = random.Random((seed * 100003 + index) * 1009 + page)
+    blocks = []
+    image_every = max(1, paragraphs // images) if images else 0
+    image_number = 0
+    for j in range(paragraphs):
+        text = synthetic_text(rng, words)
+        kind = j % 4
+        if kind == 0:
+            body = f"{text}<button class=\"comment-marker on-inline-comments-modal\" data-pid=\"p{j}\">{j}</button>"
+        elif kind == 1:
+            # Вложенный блок, из-за которого HTML5-парсеры закрывают абзац раньше
+            body = f"<b>{text}</b><div class=\"component-wrapper\" data-pid=\"p{j}\"><span>{j}</span></div> хвост&nbsp;абзаца"
+        elif kind == 2:
+            body = f"{text} <!-- служебный комментарий --> <i>курсив</i> &amp; &#11;символ"
+        else:
+            body = text
+        pid = f"{index}-{j}" if page == 1 else f"{index}-{page}-{j}"
+        blocks.append(f'<p data-p-id="{pid}">{body}</p>')
+        if images and j % image_every == image_every - 1 and image_number < images:
+            image_number += 1
+            blocks.append(image_block(f"{base_url}/img/c{index}_{image_number}.png", f"Иллюстрация {image_number}", pid))
+    return blocks
+
+def synthetic_chapter_html(index, paragraphs=30, words=40, images=1, base_url='', with_pre=True, seed=0,
+                           page=1, page_count=1):
+    """Страница главы: абзацы с маркерами комментариев, вложенными блоками и изображениями.
+
+    У многостраничной главы на первой странице есть ссылки на остальные.
+    """
+    if with_pre:
+        image_block = lambda src, alt, pid: f'<figure><img src="{src}" alt="{alt}"></figure>'
+    else:
+        image_block = lambda src, alt, pid: f'<img src="{src}" alt="{alt}">'
+    blocks = synthetic_chapter_blocks(index, paragraphs, words, images, base_url, image_block, seed, page)
+    body = f"<pre>{''.join(blocks)}</pre>" if with_pre else ''.join(blocks)
+    pagination = ''
+    if page == 1 and page_count > 1:
+        pagination = '<div class="pagination">' + ''.join(
+            f'<a href="{base_url}/{100000 + index}-chapter-{index}/page/{n}">{n}</a>' for n in range(2, page_count + 1)) + '</div>'
+    return f"""<!DOCTYPE html><html><head><meta charset="utf-8"><title>Глава {index}</title>
+<script>window.prefetched = {{"part": {index}}};</script></head><body>
+<div class="story-stats"><span class="reads" title="Прочтения">{index * 1000:,} прочтений</span>
+<span class="votes">{index * 10} голосов</span></div><span class="comments on-comments"><a>{index * 3}</a></span>
+<div class="page"><div class="panel panel-reading" dir="ltr">{body}</div></div>{pagination}</body></html>"""
+
+def synthetic_story_json(chapter_count, base_url='', revision=0):
+    """Ответ /api/v3/stories/{id}?fields=... с той же историей, что и synthetic_story_html.
+
+    revision — номер правки текста глав; от него зависит modifyDate частей.
+    """
+    return json.dumps({
+        'id': '1',
+        'title': "Синтетическая история & тест",
+        'user': {'name': 'synthetic_author'},
+        'description': "Описание истории\nв две строки",
+        'tags': ['приключения', 'фэнтези'],
+        'readCount': 1234567,
+        'voteCount': 45678,
+        'cover': f"{base_url}/img/cover.png",
+        'parts': [{'id': 100000 + i, 'title': f"Глава {i}", 'url': f"{base_url}/{100000 + i}-chapter-{i}",
+                   'readCount': i * 1000, 'voteCount': i * 10, 'commentCount': i * 3,
+                   'modifyDate': f"2025-01-{1 + revision % 28:02d}T00:00:00Z", 'length': 1000 + revision}
+                  for i in range(1, chapter_count + 1)],
+    }, ensure_ascii=False)
+
+def synthetic_storytext(index, paragraphs=30, words=40, images=1, base_url='', page_count=1, seed=0):
+    """Ответ /apiv2/storytext?id=...: все страницы главы одним фрагментом, изображения внутри абзацев."""
+    image_block = lambda src, alt, pid: f'<p data-p-id="{pid}-img" style="text-align:center;"><img src="{src}" alt="{alt}"></p>'
+    return ''.join(''.join(synthetic_chapter_blocks(index, paragraphs, words, images if page == 1 else 0, base_url,
+                                                    image_block, seed, page))
+                   for page in range(1, page_count + 1))
+
+# Известные расхождения LxmlParser с html.parser: libxml2 перестраивает дерево.
+# Они печатаются в отчёте, но не проваливают проверку
+PARSER_EDGE_CASES = {
+    # Блок после закрытого абзаца выглядит так же, как блок, вложенный в абзац
+    'div_after_p': '<p data-p-id="a">x<b>y</b></p><div>free div</div><p data-p-id="b">z</p>',
+    'table_in_p': '<p data-p-id="a">tail<table><tr><td>cell</td></tr></table>after</p><p data-p-id="b">z</p>',
+    'nested_p': '<p data-p-id="a">outer<p data-p-id="b">inner</p>rest</p><p data-p-id="c">z</p>',
+}
+
+def parser_fixtures(args):
+    """Возвращает список (имя, HTML, является ли страницей истории)."""
+    if args.fixtures:
+        pages = []
+        for path in sorted(glob.glob(os.path.join(args.fixtures, '*.html'))):
+            with open(path, encoding='utf-8') as f:
+                html = f.read()
+            pages.append((os.path.basename(path), html, 'data-testid="toc"' in html))
+        return pages
+    pages = [('story', synthetic_story_html(args.chapters), True)]
+    for i in range(1, args.chapters + 1):
+        pages.append((f"chapter_{i}", synthetic_chapter_html(i, args.paragraphs, args.words, args.images, with_pre=i % 5 != 0), False))
+    for name, body in PARSER_EDGE_CASES.items():
+        pages.append((name, f'<html><body><div class="panel-reading"><pre>{body}</pre></div></body></html>', False))
+    return pages
+
+def parse_page(parser, html, is_story, index):
+    doc = parser.parse(html)
+    if is_story:
+        return parser.story_metadata(doc), parser.chapter_list(doc)
+    return parser.chapter_content(doc, index), parser.chapter_stats(doc)
+
+def bench_parsers(args):
+    pages = parser_fixtures(args)
+    names = sorted(wd.PARSER_BACKENDS)
+    parsers = {name: wd.get_parser(name) for name in names}
+    # Проверка совпадения результатов всех парсеров с html.parser
+    mismatches = 0
+    known = 0
+    for index, (page_name, html, is_story) in enumerate(pages):
+        expected = parse_page(parsers['html.parser'], html, is_story, index)
+        for name in names:
+            matches = parse_page(parsers[name], html, is_story, index) == expected
+            if name == 'lxml' and page_name in PARSER_EDGE_CASES:
+                if matches:
+                    print(f"lxml совпадает на {page_name}: случай можно убрать из PARSER_EDGE_CASES", file=sys.stderr)
+                else:
+                    known += 1
+            elif not matches:
+                mismatches += 1
+                print(f"Расхождение: {name} на {page_name}", file=sys.stderr)
+    print(f"Страниц: {len(pages)}, расхождений с html.parser: {mismatches}, известных расхождений lxml: {known}")
+
+    chapters = [(index, html) for index, (_, html, is_story) in enumerate(pages) if not is_story]
+    for name in names:
+        parser = parsers[name]
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            for index, html in chapters:
+                parse_page(parser, html, False, index)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>12}: {len(chapters) * args.rounds / elapsed:8.1f} глав/с")
+    if args.processes:
+        pages = [(html.encode('utf-8'), 'utf-8', index) for index, html in chapters] * args.rounds
+        for processes in args.processes:
+            wd.configure_parse_pool(processes)
+            # Прогрев: запуск процессов не входит в замер
+            wd.parse_chapter_in_pool(pages[0][:2], 0)
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=processes * 2) as executor:
+                for _ in executor.map(lambda page: wd.parse_chapter_in_pool(page[:2], page[2]), pages):
+                    pass
+            elapsed = time.perf_counter() - start
+            print(f"{processes:>3} процесс(ов): {len(pages) / elapsed:8.1f} глав/с")
+        wd.configure_parse_pool(0)
+    if mismatches:
+        sys.exit(1)
+
+def synthetic_metadata(chapter_count):
+    return {'title': 'Синтетическая книга', 'author': 'synthetic_author', 'description': 'Описание',
+            'tags': 'тест', 'cover_path': None,
+            'stats': {'views': '1', 'votes': '1', 'chapters': str(chapter_count)}}
+
+def synthetic_chapters(chapter_count, paragraphs, words):
+    """Главы по одной, чтобы длинную книгу можно было записать в файл, не держа её в памяти."""
+    rng = random.Random(chapter_count)
+    for i in range(chapter_count):
+        yield {'index': i, 'title': f"Глава {i + 1}", 'url': f"/chapter/{i}",
+               'stats': {'views': '1', 'votes': '1', 'comments': '0'},
+               'content': [{'type': 'text', 'value': synthetic_text(rng, words)} for _ in range(paragraphs)]}
+
+def synthetic_book(chapter_count, paragraphs, words):
+    """Метаданные и главы в том виде, в каком их получают экспортёры."""
+    return synthetic_metadata(chapter_count), list(synthetic_chapters(chapter_count, paragraphs, words))
+
+def pdf_run(chapter_count, paragraphs, words, chunk_chapters, processes):
+    """Собирает PDF в отдельном процессе; возвращает время и пиковую память в МБ."""
+    wd.configure_pdf(chunk_chapters, processes)
+    with tempfile.TemporaryDirectory() as output_dir:
+        # Книга пишется в файл заранее и не держится в памяти: замеряется тот же путь, что и в export_book
+        book_file = os.path.join(output_dir, 'book.book.jsonl')
+        toc = [{'title': f"Глава {i + 1}", 'url': f"/chapter/{i}"} for i in range(chapter_count)]
+        wd.write_book(wd.BookWriter(book_file, synthetic_metadata(chapter_count), toc),
+                      synthetic_chapters(chapter_count, paragraphs, words))
+        start = time.perf_counter()
+        wd.export_book(book_file, 'pdf', os.path.join(output_dir, 'book.pdf'))
+        elapsed = time.perf_counter() - start
+    # ru_maxrss в Linux указан в КБ; процессы вёрстки частей учитываются отдельно
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return elapsed, max(own, children)
+
+def bench_pdf(args):
+    modes = [('одним документом', 10 ** 9, 1), (f"части по {args.chunk}", args.chunk, 1)]
+    if args.processes > 1:
+        modes.append((f"части по {args.chunk}, {args.processes} проц.", args.chunk, args.processes))
+    if wd.pypdf is None:
+        print("pypdf не установлен: сборка частями недоступна")
+        modes = modes[:1]
+    print(f"{'глав':>6} {'режим':>28} {'время, с':>9} {'пик RSS, МБ':>12}")
+    # Каждый замер — в свежем процессе, чтобы пик памяти не переходил между замерами
+    context = multiprocessing.get_context('spawn')
+    for chapter_count in args.chapters:
+        for name, chunk, processes in modes:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                elapsed, rss = executor.submit(pdf_run, chapter_count, args.paragraphs, args.words,
+                                               chunk, processes).result()
+            print(f"{chapter_count:>6} {name:>28} {elapsed:9.2f} {rss:12.1f}")
+
+# Прозрачный PNG 1x1
+TINY_PNG = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==')
+
+def synthetic_epub_book(output_dir, chapter_count, paragraphs, words, images):
+    """Книга с изображениями и символами, которые нужно экранировать в XHTML."""
+    metadata, chapters = synthetic_book(chapter_count, paragraphs, words)
+    metadata['title'] = 'Книга <тест> & "кавычки"'
+    os.makedirs(os.path.join(output_dir, 'images'), exist_ok=True)
+    for chapter in chapters:
+        chapter['content'][0]['value'] += ' a < b && c > d'
+        for n in range(images):
+            # Половина изображений повторяется между главами, как общие баннеры
+            path = f"images/{chapter['index'] % 2 if n % 2 else chapter['index']}_{n}.png"
+            with open(os.path.join(output_dir, path), 'wb') as f:
+                f.write(TINY_PNG)
+            chapter['content'].insert(1 + n, {'type': 'image', 'path': path, 'alt': 'Иллюстрация "1" & <2>'})
+    return metadata, chapters
+
+def validate_epub(path):
+    """Проверяет контейнер EPUB 3; возвращает список найденных проблем."""
+    problems = []
+    with zipfile.ZipFile(path) as book:
+        infos = book.infolist()
+        names = set(book.namelist())
+        if not infos or infos[0].filename != 'mimetype' or infos[0].compress_type != zipfile.ZIP_STORED \
+                or book.read('mimetype') != b'application/epub+zip' or infos[0].extra:
+            problems.append("mimetype должен быть первым файлом, без сжатия и дополнительных полей")
+        ns = {'c': 'urn:oasis:names:tc:opendocument:xmlns:container', 'opf': 'http://www.idpf.org/2007/opf',
+              'x': 'http://www.w3.org/1999/xhtml'}
+        rootfile = ET.fromstring(book.read('META-INF/container.xml')).find('.//c:rootfile', ns).get('full-path')
+        opf = ET.fromstring(book.read(rootfile))
+        base = posixpath.dirname(rootfile)
+        items = {item.get('id'): item for item in opf.findall('opf:manifest/opf:item', ns)}
+        hrefs = {posixpath.join(base, item.get('href')) for item in items.values()}
+        for href in sorted(hrefs - names):
+            problems.append(f"в манифесте есть {href}, но его нет в архиве")
+        for name in sorted(names - hrefs - {'mimetype', 'META-INF/container.xml', rootfile}):
+            problems.append(f"файл {name} отсутствует в манифесте")
+        for itemref in opf.findall('opf:spine/opf:itemref', ns):
+            if itemref.get('idref') not in items:
+                problems.append(f"spine ссылается на неизвестный id {itemref.get('idref')}")
+        if not any('nav' in (item.get('properties') or '').split() for item in items.values()):
+            problems.append("нет документа навигации (properties=\"nav\")")
+        if opf.find('opf:metadata/{http://purl.org/dc/elements/1.1/}identifier', ns) is None:
+            problems.append("нет dc:identifier")
+        for item in items.values():
+            name = posixpath.join(base, item.get('href'))
+            if name not in names or not name.endswith(('.xhtml', '.ncx', '.opf')):
+                continue
+            try:
+                doc = ET.fromstring(book.read(name))
+            except ET.ParseError as e:
+                problems.append(f"{name}: невалидный XML: {e}")
+                continue
+            # Ссылки и изображения должны вести на файлы внутри книги
+            for element in doc.iter():
+                target = element.get('src') if element.tag in ('{%s}img' % ns['x'], '{http://www.daisy.org/z3986/2005/ncx/}content') \
+                    else element.get('href') if element.tag == '{%s}a' % ns['x'] else None
+                if target and posixpath.join(posixpath.dirname(name), target.split('#')[0]) not in names:
+                    problems.append(f"{name}: ссылка на отсутствующий файл {target}")
+    # Полная проверка по спецификации, если epubcheck установлен
+    if shutil.which('epubcheck'):
+        result = subprocess.run(['epubcheck', path], capture_output=True, text=True)
+        if result.returncode:
+            problems.append(f"epubcheck: {result.stdout.strip() or result.stderr.strip()}")
+    return problems
+
+def epub_run(chapter_count, paragraphs, words, images):
+    """Пишет EPUB в отдельном процессе; возвращает время, память данных и прирост пика при записи (МБ), проблемы."""
+    with tempfile.TemporaryDirectory() as output_dir:
+        metadata, chapters = synthetic_epub_book(output_dir, chapter_count, paragraphs, words, images)
+        output_file = os.path.join(output_dir, 'book.epub')
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        start = time.perf_counter()
+        wd.save_to_epub(metadata, chapters, output_file)
+        elapsed = time.perf_counter() - start
+        growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - before
+        problems = validate_epub(output_file)
+    return elapsed, before, growth, problems
+
+def bench_epub(args):
+    # Входные главы лежат в памяти процесса замера; запись оценивается по приросту пика RSS
+    print(f"{'глав':>6} {'время, с':>9} {'данные, МБ':>11} {'прирост при записи, МБ':>23}  проверка")
+    context = multiprocessing.get_context('spawn')
+    failed = False
+    for chapter_count in args.chapters:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            elapsed, before, growth, problems = executor.submit(epub_run, chapter_count, args.paragraphs, args.words,
+                                                     args.images).result()
+        print(f"{chapter_count:>6} {elapsed:9.2f} {before:11.1f} {growth:23.1f}  {'ошибок: ' + str(len(problems)) if problems else 'ок'}")
+        for problem in problems[:20]:
+            print(f"  {problem}", file=sys.stderr)
+        failed = failed or bool(problems)
+    if args.validate:
+        problems = validate_epub(args.validate)
+        print(f"{args.validate}: {'ок' if not problems else 'ошибок: ' + str(len(problems))}")
+        for problem in problems:
+            print(f"  {problem}", file=sys.stderr)
+        failed = failed or bool(problems)
+    if failed:
+        sys.exit(1)
+
+@lru_cache(maxsize=256)
+def synthetic_png(name, kilobytes):
+    """Уникальный для каждого имени PNG с шумом; шум почти не сжимается, поэтому размер ~kilobytes."""
+    rng = random.Random(name)
+    side = max(1, int((kilobytes * 1024 / 3) ** 0.5))
+    raw = b''.join(b'\x00' + rng.randbytes(side * 3) for _ in range(side))
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', side, side, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw, 1)) + chunk(b'IEND', b''))
+
+class WattpadStandInHandler(StandInHandler):
+    """Локальная замена Wattpad: страница истории, главы (в том числе многостраничные) и изображения.
+
+    Те же история и главы отдаются и через JSON API (/api/v3/stories, /apiv2/storytext).
+    Необязательный server.config.revision меняет текст всех глав, как правка автором.
+
+    Параметры книги, задержки и доля ошибок берутся из server.config.
+    """
+
+    def do_GET(self):
+        config = self.server.config
+        if config.latency_ms:
+            time.sleep(config.latency_ms / 1000 * random.uniform(0.5, 1.5))
+        if random.random() < config.throttle_rate:
+            return self.send_body(b'slow down', status=429, headers={'Retry-After': '1'})
+        if random.random() < config.error_rate:
+            return self.send_body(b'unavailable', status=503)
+        base_url = f"http://{self.headers['Host']}"
+        path = urllib.parse.urlparse(self.path).path
+        chapter = re.fullmatch(r'/(\d+)-chapter-(\d+)(?:/page/(\d+))?', path)
+        image = re.fullmatch(r'/img/([\w.-]+)\.png', path)
+        revision = getattr(config, 'revision', 0)
+        part_id = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query).get('id', ['0'])[0]
+        if path.startswith('/api/v3/stories/'):
+            self.send_body(synthetic_story_json(config.chapters, base_url, revision).encode('utf-8'), 'application/json')
+        elif (path == '/apiv2/storytext' and 1 <= int(part_id) - 100000 <= config.chapters
+              and not (getattr(config, 'broken_parts', 0) and int(part_id) % config.broken_parts == 0)):
+            text = synthetic_storytext(int(part_id) - 100000, config.paragraphs, config.words, config.images,
+                                       base_url, config.pages, revision)
+            self.send_body(text.encode('utf-8'))
+        elif path.startswith('/story/'):
+            self.send_body(synthetic_story_html(config.chapters, base_url).encode('utf-8'))
+        elif chapter and 1 <= int(chapter.group(2)) <= config.chapters and int(chapter.group(3) or 1) <= config.pages:
+            index, page = int(chapter.group(2)), int(chapter.group(3) or 1)
+            html = synthetic_chapter_html(index, config.paragraphs, config.words, config.images if page == 1 else 0,
+                                          base_url, seed=revision, page=page, page_count=config.pages)
+            self.send_body(html.encode('utf-8'))
+        elif image:
+            self.send_body(synthetic_png(image.group(1), config.image_kb), 'image/png')
+        else:
+            self.send_body(b'not found', status=404)
+
+    def send_body(self, body, content_type='text/html; charset=utf-8', status=200, headers=None):
+        # ETag по содержимому: условный запрос из кеша HTTP получает 304 для неизменённого ответа
+        if status == 200:
+            etag = f'"{hashlib.md5(body).hexdigest()}"'
+            if self.headers.get('If-None-Match') == etag:
+                return super().send_body(b'', content_type, 304, {'ETag': etag})
+            headers = dict(headers or {}, ETag=etag)
+        super().send_body(body, content_type, status, headers)
+
+def e2e_run(story_url, argv):
+    """Запускает main() в отдельном процессе; возвращает время, метрики и пиковую память (МБ)."""
+    with tempfile.TemporaryDirectory() as output_dir:
+        start = time.perf_counter()
+        # Тихий журнал и без ограничения частоты; аргументы варианта могут это переопределить
+        wd.main([story_url, '--output', os.path.join(output_dir, 'book'), '--log-level', 'ERROR', '--rate', '0'] + argv)
+        elapsed = time.perf_counter() - start
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    pools = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return {'elapsed': elapsed, 'metrics': wd.metrics.snapshot(), 'peak_rss_mb': own, 'pool_peak_rss_mb': pools}
+
+def bench_e2e(args):
+    server, base_url = start_server(WattpadStandInHandler)
+    server.config = args
+    story_url = f"{base_url}/story/1-synthetic"
+    print(f"Глав: {args.chapters} по {args.pages} стр., абзацев: {args.paragraphs}, изображений в главе: {args.images} "
+          f"по {args.image_kb} КБ, задержка: {args.latency_ms} мс, ошибки: 503 {args.error_rate:.0%}, 429 {args.throttle_rate:.0%}")
+    print(f"{'вариант':<32} {'время, с':>9} {'глав/с':>8} {'МБ':>7} {'запросов':>9} {'повторов':>9} {'RSS, МБ':>8} {'RSS пулов':>10}")
+    # Каждый запуск — в свежем процессе: метрики и пик памяти не смешиваются между запусками
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for variant in args.variant:
+        runs = []
+        for _ in range(args.runs):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                run = executor.submit(e2e_run, story_url, shlex.split(variant)).result()
+            runs.append(run)
+            counters = run['metrics']['counters']
+            print(f"{variant or 'по умолчанию':<32} {run['elapsed']:9.2f} {counters.get('chapters', 0) / run['elapsed']:8.1f} "
+                  f"{counters.get('http_bytes', 0) / 1024 / 1024:7.1f} {counters.get('http_requests', 0):9} "
+                  f"{counters.get('http_retries', 0):9} {run['peak_rss_mb']:8.1f} {run['pool_peak_rss_mb']:10.1f}")
+        stages = runs[-1]['metrics']['stages']
+        print("  стадии: " + ", ".join(f"{stage} {stats['seconds']:.2f} с" for stage, stats in sorted(stages.items())))
+        if args.runs > 1:
+            print(f"  медиана времени: {statistics.median(run['elapsed'] for run in runs):.2f} с")
+        results.append({'variant': variant, 'runs': runs})
+    server.shutdown()
+    if args.json:
+        wd.write_json_atomic(args.json, {'config': {name: value for name, value in vars(args).items() if name != 'func'},
+                                         'results': results})
+
+def source_run(story_url, output_base, source):
+    """Загружает историю в output_base из указанного источника; возвращает время и метрики."""
+    start = time.perf_counter()
+    wd.main([story_url, '--output', output_base, '--source', source, '--formats', 'md',
+             '--log-level', 'ERROR', '--rate', '0'])
+    return {'elapsed': time.perf_counter() - start, 'metrics': wd.metrics.snapshot()}
+
+def bench_source(args):
+    """Сравнивает загрузку через HTML-страницы и через JSON API на одной и той же истории."""
+    server, base_url = start_server(WattpadStandInHandler)
+    server.config = args
+    story_url = f"{base_url}/story/1-synthetic"
+    context = multiprocessing.get_context('spawn')
+    books = {}
+    broken = f"каждая {args.broken_parts}-я" if args.broken_parts else "нет"
+    print(f"Глав: {args.chapters} по {args.pages} стр., абзацев: {args.paragraphs}, глав без текста в API: {broken}")
+    print(f"{'источник':<10} {'время, с':>9} {'МБ':>7} {'КБ/глава':>9} {'запросов':>9} {'разбор, с':>10} {'откатов':>8}")
+    with tempfile.TemporaryDirectory() as output_dir:
+        for source in ('html', 'api'):
+            output_base = os.path.join(output_dir, source, 'book')
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                run = executor.submit(source_run, story_url, output_base, source).result()
+            counters = run['metrics']['counters']
+            parse = run['metrics']['stages'].get('parse', {}).get('seconds', 0)
+            print(f"{source:<10} {run['elapsed']:9.2f} {counters.get('http_bytes', 0) / 1024 / 1024:7.2f} "
+                  f"{counters.get('http_bytes', 0) / 1024 / max(1, counters.get('chapters', 0)):9.1f} "
+                  f"{counters.get('http_requests', 0):9} {parse:10.2f} {counters.get('api_fallbacks', 0):8}")
+            books[source] = wd.load_book(f"{output_base}.book.jsonl")
+    server.shutdown()
+    # Главы и основные метаданные из обоих источников должны совпадать
+    (html_metadata, html_toc, html_chapters), (api_metadata, api_toc, api_chapters) = books['html'], books['api']
+    keys = ('title', 'author', 'tags', 'stats')
+    mismatches = [key for key in keys if html_metadata[key] != api_metadata[key]]
+    mismatches += ['toc'] if html_toc != api_toc else []
+    mismatches += [f"глава {i}" for i, (a, b) in enumerate(zip(html_chapters, api_chapters), 1) if a != b]
+    if len(html_chapters) != len(api_chapters):
+        mismatches.append(f"число глав {len(html_chapters)} и {len(api_chapters)}")
+    print(f"Расхождений HTML и API: {len(mismatches)}")
+    for mismatch in mismatches:
+        print(f"  {mismatch}", file=sys.stderr)
+    if mismatches:
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки загрузчика Wattpad на локальном HTTP-сервере")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    http_parser = subparsers.add_parser('http', help="Сравнение requests.get и общей сессии с пулом соединений")
+    http_parser.add_argument('--requests', type=int, default=500)
+    http_parser.add_argument('--workers', type=int, default=wd.MAX_WORKERS)
+    http_parser.set_defaults(func=bench_http)
+    parsers_parser = subparsers.add_parser('parsers', help="Совпадение результатов и скорость парсеров HTML")
+    parsers_parser.add_argument('--fixtures', help="Каталог с сохранёнными страницами *.html вместо синтетических")
+    parsers_parser.add_argument('--chapters', type=int, default=50)
+    parsers_parser.add_argument('--paragraphs', type=int, default=60)
+    parsers_parser.add_argument('--words', type=int, default=40)
+    parsers_parser.add_argument('--images', type=int, default=2)
+    parsers_parser.add_argument('--rounds', type=int, default=3)
+    parsers_parser.add_argument('--processes', type=int, nargs='*', default=[],
+                                help="Замерить разбор в пуле из указанного числа процессов, например 1 2 4")
+    parsers_parser.set_defaults(func=bench_parsers)
+    pdf_parser = subparsers.add_parser('pdf', help="Время и пиковая память сборки PDF в зависимости от числа глав")
+    pdf_parser.add_argument('--chapters', type=int, nargs='+', default=[100, 400, 1600])
+    pdf_parser.add_argument('--paragraphs', type=int, default=30)
+    pdf_parser.add_argument('--words', type=int, default=40)
+    pdf_parser.add_argument('--chunk', type=int, default=wd.PDF_CHUNK_CHAPTERS)
+    pdf_parser.add_argument('--processes', type=int, default=4)
+    pdf_parser.set_defaults(func=bench_pdf)
+    epub_parser = subparsers.add_parser('epub', help="Проверка EPUB и память потоковой записи в зависимости от числа глав")
+    epub_parser.add_argument('--chapters', type=int, nargs='+', default=[100, 1000])
+    epub_parser.add_argument('--paragraphs', type=int, default=30)
+    epub_parser.add_argument('--words', type=int, default=40)
+    epub_parser.add_argument('--images', type=int, default=2)
+    epub_parser.add_argument('--validate', help="Дополнительно проверить готовый файл EPUB")
+    epub_parser.set_defaults(func=bench_epub)
+    e2e_parser = subparsers.add_parser('e2e', help="Полный запуск main() на локальной замене Wattpad")
+    e2e_parser.add_argument('--chapters', type=int, default=100)
+    e2e_parser.add_argument('--pages', type=int, default=1, help="Страниц в каждой главе")
+    e2e_parser.add_argument('--paragraphs', type=int, default=30, help="Абзацев на странице главы")
+    e2e_parser.add_argument('--words', type=int, default=40)
+    e2e_parser.add_argument('--images', type=int, default=1, help="Изображений в главе")
+    e2e_parser.add_argument('--image-kb', type=int, default=20, help="Размер изображения в КБ")
+    e2e_parser.add_argument('--latency-ms', type=float, default=20, help="Средняя задержка ответа сервера")
+    e2e_parser.add_argument('--error-rate', type=float, default=0.0, help="Доля ответов 503")
+    e2e_parser.add_argument('--throttle-rate', type=float, default=0.0, help="Доля ответов 429 с Retry-After")
+    e2e_parser.add_argument('--runs', type=int, default=1, help="Повторов каждого варианта")
+    e2e_parser.add_argument('--variant', action='append',
+                            help="Аргументы wattpad-download.py для сравнения, например \"--engine asyncio\"; можно несколько раз")
+    e2e_parser.add_argument('--json', help="Сохранить результаты в JSON для сравнения между версиями")
+    e2e_parser.set_defaults(func=bench_e2e)
+    source_parser = subparsers.add_parser('source', help="Совпадение и объём загрузки через HTML-страницы и JSON API")
+    source_parser.add_argument('--chapters', type=int, default=50)
+    source_parser.add_argument('--pages', type=int, default=1, help="Страниц в каждой главе")
+    source_parser.add_argument('--paragraphs', type=int, default=30, help="Абзацев на странице главы")
+    source_parser.add_argument('--words', type=int, default=40)
+    source_parser.add_argument('--images', type=int, default=1, help="Изображений в главе")
+    source_parser.add_argument('--image-kb', type=int, default=5, help="Размер изображения в КБ")
+    source_parser.add_argument('--latency-ms', type=float, default=0, help="Средняя задержка ответа сервера")
+    source_parser.add_argument('--broken-parts', type=int, default=0,
+                               help="API не отдаёт текст каждой N-й главы (проверка отката на HTML)")
+    source_parser.set_defaults(func=bench_source, error_rate=0.0, throttle_rate=0.0)
+    args = parser.parse_args()
+    if args.command == 'e2e' and not args.variant:
+        args.variant = ['']
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -3,14 +3,129 @@ from bs4 import BeautifulSoup
 import re
 import os
 import time
-from concurrent.futures import ThreadPoolExecutor
+import random
+import threading
+import email.utils
+import hashlib
+import json
+import io
+import sqlite3
+import asyncio
+import argparse
+import sys
+import contextlib
+import logging
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from requests.adapters import HTTPAdapter
 from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, PageBreak
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
-from ebooklib import epub
+from reportlab.lib.fonts import addMapping
 import urllib.parse
+import html
+import mimetypes
+import zipfile
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+log = logging.getLogger('wattpad')
+
+class Metrics:
+    """Метрики конвейера: счётчики, время стадий и глубина очередей.
+
+    Значения копятся в памяти процесса; время разбора и экспорта в пулах
+    процессов замеряется на стороне основного процесса.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.stages = {}
+        self.queues = {}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            stats = self.stages.setdefault(stage, {'count': 0, 'seconds': 0.0, 'max': 0.0})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def track(self, queue, delta):
+        """Меняет глубину очереди на delta и запоминает максимум."""
+        with self.lock:
+            stats = self.queues.setdefault(queue, {'depth': 0, 'max': 0})
+            stats['depth'] += delta
+            stats['max'] = max(stats['max'], stats['depth'])
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            stages = {stage: dict(stats) for stage, stats in self.stages.items()}
+            queues = {queue: dict(stats) for queue, stats in self.queues.items()}
+        lookups = counters.get('cache_hits', 0) + counters.get('cache_misses', 0)
+        return {
+            'counters': counters,
+            'stages': stages,
+            'queues': queues,
+            'cache_hit_rate': counters.get('cache_hits', 0) / lookups if lookups else None,
+        }
+
+    def prometheus(self):
+        """Метрики в текстовом формате Prometheus."""
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f"# TYPE wattpad_{name}_total counter")
+            lines.append(f"wattpad_{name}_total {value}")
+        lines.append("# TYPE wattpad_stage_seconds summary")
+        for stage, stats in sorted(snapshot['stages'].items()):
+            lines.append(f'wattpad_stage_seconds_sum{{stage="{stage}"}} {stats["seconds"]:.6f}')
+            lines.append(f'wattpad_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        lines.append("# TYPE wattpad_queue_depth gauge")
+        for queue, stats in sorted(snapshot['queues'].items()):
+            lines.append(f'wattpad_queue_depth{{queue="{queue}"}} {stats["depth"]}')
+        lines.append("# TYPE wattpad_queue_depth_max gauge")
+        for queue, stats in sorted(snapshot['queues'].items()):
+            lines.append(f'wattpad_queue_depth_max{{queue="{queue}"}} {stats["max"]}')
+        if snapshot['cache_hit_rate'] is not None:
+            lines.append("# TYPE wattpad_cache_hit_ratio gauge")
+            lines.append(f"wattpad_cache_hit_ratio {snapshot['cache_hit_rate']:.6f}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
 
 def clean_xml_string(text):
     """Удаляет невалидные XML-символы из строки."""
@@ -19,39 +134,471 @@ def clean_xml_string(text):
     # Удаляем управляющие символы (0x00–0x1F, кроме 0x09, 0x0A, 0x0D)
     return re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F]', '', text)
 
-def get_page_content(url, cookies=None):
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
+# Общие настройки HTTP-клиента для страниц и изображений
+HTTP_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+HTTP_TIMEOUT = 10
+MAX_WORKERS = 5
+# Лимиты движка asyncio: всего запросов в полёте и на один хост
+ASYNC_CONCURRENCY = 32
+ASYNC_PER_HOST = 16
+# Больше страниц у главы Wattpad не бывает; защита от ошибочного числа из данных страницы
+MAX_CHAPTER_PAGES = 50
+# Повторы запросов: экспоненциальная задержка с джиттером
+RETRY_ATTEMPTS = 5
+RETRY_BACKOFF = 1.0
+RETRY_MAX_DELAY = 60.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+THROTTLE_STATUSES = {429, 503}
+# Ограничение частоты запросов (запросов в секунду, 0 — без ограничения).
+# По умолчанию потолка нет: темп задают AIMD-лимит одновременных запросов и Retry-After
+RATE_LIMIT = 0.0
+# Размер дискового кеша HTTP-ответов по умолчанию
+CACHE_MAX_MB = 1024
+# Поля истории в JSON API: метаданные и оглавление одним ответом вместо полной HTML-страницы
+API_STORY_FIELDS = ("id,title,user(name),description,tags,readCount,voteCount,cover,"
+                    "parts(id,title,url,readCount,voteCount,commentCount,modifyDate,length)")
+METRICS_INTERVAL = 10
+
+_http_lock = threading.Lock()
+_http_local = threading.local()
+_http_config = {'adapter': None, 'timeout': HTTP_TIMEOUT, 'headers': dict(HTTP_HEADERS), 'generation': 0}
+
+def configure_session(pool_size=MAX_WORKERS, timeout=HTTP_TIMEOUT, headers=None, max_hosts=10):
+    """Настраивает общий пул keep-alive соединений (pool_size соединений на хост)."""
+    adapter = HTTPAdapter(pool_connections=max_hosts, pool_maxsize=pool_size)
+    merged_headers = dict(HTTP_HEADERS)
+    if headers:
+        merged_headers.update(headers)
+    with _http_lock:
+        old_adapter = _http_config['adapter']
+        _http_config.update(adapter=adapter, timeout=timeout, headers=merged_headers)
+        _http_config['generation'] += 1
+    if old_adapter:
+        old_adapter.close()
+
+def get_session():
+    """Возвращает сессию текущего потока; все сессии делят один пул соединений."""
+    with _http_lock:
+        if _http_config['adapter'] is None:
+            _http_config['adapter'] = HTTPAdapter(pool_connections=10, pool_maxsize=MAX_WORKERS)
+        adapter = _http_config['adapter']
+        generation = _http_config['generation']
+        headers = _http_config['headers']
+    session = getattr(_http_local, 'session', None)
+    if session is None or _http_local.generation != generation:
+        session = requests.Session()
+        session.headers.update(headers)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _http_local.session = session
+        _http_local.generation = generation
+    return session
+
+class AdaptiveRateLimiter:
+    """Token bucket для частоты запросов и AIMD-лимит одновременных запросов.
+
+    Ответы 429/503 вдвое снижают лимит и, при наличии Retry-After, ставят все
+    запросы на паузу; после периода остывания лимит медленно растёт обратно.
+    """
+
+    def __init__(self, rate=RATE_LIMIT, max_concurrency=MAX_WORKERS, min_concurrency=1, cooldown=10.0):
+        self.rate = rate
+        self.burst = max(1.0, rate)
+        self.tokens = self.burst
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(max_concurrency)
+        self.cooldown = cooldown
+        self.active = 0
+        self.updated = time.monotonic()
+        self.pause_until = 0.0
+        self.decreased_at = float('-inf')
+        self.condition = threading.Condition()
+
+    def _try_acquire(self):
+        """Занимает слот и токен; иначе возвращает, сколько секунд подождать."""
+        now = time.monotonic()
+        if now < self.pause_until:
+            return self.pause_until - now
+        if self.active >= int(self.limit):
+            return 0.05
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+        self.active += 1
+        metrics.track('http_in_flight', 1)
+        return 0
+
+    def try_acquire(self):
+        with self.condition:
+            return self._try_acquire()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                wait = self._try_acquire()
+                if not wait:
+                    return
+                self.condition.wait(wait)
+
+    def release(self, throttled=False, retry_after=None):
+        with self.condition:
+            self.active -= 1
+            metrics.track('http_in_flight', -1)
+            now = time.monotonic()
+            if throttled:
+                # Несколько 429 из одного окна снижают лимит только один раз
+                if now - self.decreased_at > 1.0:
+                    limit = max(self.min_concurrency, self.limit / 2)
+                    if int(limit) < int(self.limit):
+                        metrics.count('http_limit_decreases')
+                        log.warning("Сервер ограничивает запросы, лимит одновременных запросов: %s", int(limit))
+                    self.limit = limit
+                    self.decreased_at = now
+                if retry_after:
+                    self.pause_until = max(self.pause_until, now + retry_after)
+            elif now - self.decreased_at > self.cooldown:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+_rate_limiter = AdaptiveRateLimiter()
+
+def configure_rate_limit(rate=RATE_LIMIT, max_concurrency=MAX_WORKERS):
+    global _rate_limiter
+    _rate_limiter = AdaptiveRateLimiter(rate=rate, max_concurrency=max_concurrency)
+
+def parse_retry_after(value):
+    """Возвращает задержку из Retry-After в секундах (число или HTTP-дата)."""
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
     try:
-        response = requests.get(url, headers=headers, cookies=cookies, timeout=10)
-        response.raise_for_status()
-        print(f"Успешно загружена страница: {url}")
-        return response.text
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+def retry_delay(attempt, retry_after=None):
+    if retry_after is not None:
+        return min(retry_after, RETRY_MAX_DELAY)
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BACKOFF * 2 ** attempt))
+
+def http_get(url, cookies=None, headers=None):
+    limiter = _rate_limiter
+    for attempt in range(RETRY_ATTEMPTS):
+        throttled = False
+        retry_after = None
+        limiter.acquire()
+        try:
+            response = get_session().get(url, cookies=cookies, headers=headers, timeout=_http_config['timeout'])
+            metrics.count('http_requests')
+            metrics.count('http_bytes', len(response.content))
+            if response.status_code not in RETRY_STATUSES:
+                response.raise_for_status()
+                return response
+            throttled = response.status_code in THROTTLE_STATUSES
+            metrics.count('http_throttled' if throttled else 'http_server_errors')
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            error = requests.HTTPError(f"{response.status_code} для {url}", response=response)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        finally:
+            limiter.release(throttled, retry_after)
+        if attempt == RETRY_ATTEMPTS - 1:
+            raise error
+        delay = retry_delay(attempt, retry_after)
+        metrics.count('http_retries')
+        log.warning("Повтор %s/%s для %s через %.1f с: %s", attempt + 1, RETRY_ATTEMPTS - 1, url, delay, error)
+        time.sleep(delay)
+
+class HttpCache:
+    """Дисковый кеш HTTP-ответов в SQLite.
+
+    Тела хранятся по SHA-256 содержимого (одинаковые ответы с разных URL
+    занимают место один раз), для URL запоминаются ETag и Last-Modified.
+    При превышении max_bytes вытесняются давно не использованные URL.
+    """
+
+    def __init__(self, cache_dir, max_bytes=CACHE_MAX_MB * 1024 * 1024):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(cache_dir, 'http_cache.sqlite3'), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS blobs (
+            digest TEXT PRIMARY KEY, size INTEGER NOT NULL, data BLOB NOT NULL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS responses (
+            url TEXT PRIMARY KEY, digest TEXT NOT NULL, etag TEXT, last_modified TEXT,
+            encoding TEXT, fetched_at REAL NOT NULL, accessed_at REAL NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+        self.db.commit()
+
+    def lookup(self, url):
+        with self.lock:
+            row = self.db.execute("SELECT digest, etag, last_modified, encoding FROM responses WHERE url = ?",
+                                  (url,)).fetchone()
+        if row is None:
+            return None
+        return {'url': url, 'digest': row[0], 'etag': row[1], 'last_modified': row[2], 'encoding': row[3]}
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def load(self, entry):
+        """Возвращает (тело, кодировка) записи и отмечает её как недавно использованную."""
+        with self.lock:
+            row = self.db.execute("SELECT data FROM blobs WHERE digest = ?", (entry['digest'],)).fetchone()
+            self.db.execute("UPDATE responses SET accessed_at = ? WHERE url = ?", (time.time(), entry['url']))
+            self.db.commit()
+        return (bytes(row[0]), entry['encoding']) if row else (None, None)
+
+    def store(self, url, body, etag=None, last_modified=None, encoding=None):
+        digest = hashlib.sha256(body).hexdigest()
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO blobs (digest, size, data) VALUES (?, ?, ?)",
+                            (digest, len(body), body))
+            self.db.execute("""INSERT OR REPLACE INTO responses
+                (url, digest, etag, last_modified, encoding, fetched_at, accessed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""", (url, digest, etag, last_modified, encoding, now, now))
+            self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Освобождаем с запасом, чтобы не чистить кеш на каждой записи
+        target = self.max_bytes * 0.9
+        for url, digest in self.db.execute("SELECT url, digest FROM responses ORDER BY accessed_at").fetchall():
+            if total <= target:
+                break
+            self.db.execute("DELETE FROM responses WHERE url = ?", (url,))
+            if not self.db.execute("SELECT 1 FROM responses WHERE digest = ? LIMIT 1", (digest,)).fetchone():
+                size = self.db.execute("SELECT size FROM blobs WHERE digest = ?", (digest,)).fetchone()
+                self.db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+                total -= size[0] if size else 0
+
+_http_cache = None
+
+def configure_cache(cache_dir, max_mb=CACHE_MAX_MB):
+    global _http_cache
+    _http_cache = HttpCache(cache_dir, int(max_mb * 1024 * 1024)) if cache_dir else None
+
+def fetch_url(url, cookies=None, revalidate=True):
+    """Загружает URL через дисковый кеш; возвращает (тело в байтах, кодировка).
+
+    Без revalidate закешированный ответ отдаётся без обращения к сети
+    (изображения Wattpad неизменны по своему URL), иначе отправляется
+    условный запрос и ответ 304 обслуживается из кеша.
+    """
+    cache = _http_cache
+    entry = cache.lookup(url) if cache else None
+    if entry and not revalidate:
+        body, encoding = cache.load(entry)
+        if body is not None:
+            metrics.count('cache_hits')
+            return body, encoding
+    response = http_get(url, cookies=cookies, headers=cache.conditional_headers(entry) if entry else None)
+    if response.status_code == 304 and entry:
+        body, encoding = cache.load(entry)
+        if body is not None:
+            metrics.count('cache_hits')
+            return body, encoding
+        response = http_get(url, cookies=cookies)
+    if cache:
+        metrics.count('cache_misses')
+        cache.store(url, response.content, response.headers.get('ETag'),
+                    response.headers.get('Last-Modified'), response.encoding)
+    return response.content, response.encoding
+
+def fetch_page(url, cookies=None):
+    """Загружает страницу без декодирования: (тело в байтах, кодировка) или None."""
+    try:
+        with metrics.timer('fetch'):
+            page = fetch_url(url, cookies=cookies)
+        log.debug("Успешно загружена страница: %s", url)
+        return page
     except requests.RequestException as e:
-        print(f"Ошибка загрузки страницы {url}: {e}")
+        metrics.count('fetch_errors')
+        log.error("Ошибка загрузки страницы %s: %s", url, e)
         return None
 
+def get_page_content(url, cookies=None):
+    page = fetch_page(url, cookies=cookies)
+    return decode_page(*page) if page else None
+
+def decode_page(body, encoding):
+    return body.decode(encoding or 'utf-8', errors='replace')
+
 def download_image(url, output_dir, filename):
     if not url:
         return None
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
+        with metrics.timer('image'):
+            body, _ = fetch_url(url, revalidate=False)
         os.makedirs(output_dir, exist_ok=True)
         filepath = os.path.join(output_dir, filename)
         with open(filepath, 'wb') as f:
-            f.write(response.content)
-        print(f"Изображение сохранено в {filepath}")
+            f.write(body)
+        log.debug("Изображение сохранено в %s", filepath)
         return filepath
     except requests.RequestException as e:
-        print(f"Ошибка загрузки изображения {url}: {e}")
+        metrics.count('image_errors')
+        log.error("Ошибка загрузки изображения %s: %s", url, e)
         return None
 
-def parse_story_metadata(soup, output_dir):
+class ImageStore:
+    """Общее хранилище изображений книги в каталоге images/.
+
+    Каждый URL скачивается один раз в отдельном пуле потоков (submit) или,
+    в движке asyncio, задачей в цикле событий (submit_async), пока главы
+    продолжают разбираться; файлы называются по SHA-256 содержимого, поэтому
+    одинаковые баннеры и разделители с разных URL хранятся в одном экземпляре.
+    При заданных max_size/quality изображения уменьшаются и пережимаются в JPEG.
+    """
+
+    subdir = 'images'
+
+    def __init__(self, output_dir, pool, max_size=None, quality=None, known=None, checkpoint=None):
+        self.output_dir = output_dir
+        self.pool = pool
+        self.max_size = max_size
+        self.quality = quality
+        # Изображения, скачанные прошлым запуском: URL -> путь относительно каталога книги
+        self.known = known or {}
+        self.checkpoint = checkpoint
+        if (max_size or quality) and PILImage is None:
+            log.warning("Для пережатия изображений установите Pillow: pip install pillow")
+        self.lock = threading.Lock()
+        self.futures = {}
+
+    def _start(self, url, fetch, completed):
+        """Возвращает загрузку url, запуская её через fetch(url) при первом обращении."""
+        with self.lock:
+            future = self.futures.get(url)
+            if future is None and url in self.known and os.path.exists(os.path.join(self.output_dir, self.known[url])):
+                metrics.count('images_reused')
+                future = self.futures[url] = completed
+                future.set_result(self.known[url])
+            elif future is None:
+                metrics.count('images')
+                metrics.track('image_queue', 1)
+                future = self.futures[url] = fetch(url)
+            else:
+                metrics.count('images_deduplicated')
+        return future
+
+    def submit(self, url):
+        return self._start(url, lambda url: self.pool.submit(self._fetch, url), Future())
+
+    def submit_async(self, session, url):
+        """Ставит загрузку в цикл событий; вызывается из корутины движка asyncio."""
+        loop = asyncio.get_running_loop()
+        return self._start(url, lambda url: loop.create_task(self._async_fetch(session, url)), loop.create_future())
+
+    def path(self, url):
+        """Путь к изображению относительно каталога книги или None при ошибке."""
+        # Изображение уже поставлено в очередь при разборе главы; повторный submit исказил бы счётчики
+        with self.lock:
+            future = self.futures.get(url)
+        return (future or self.submit(url)).result()
+
+    def saved(self):
+        """Готовые изображения: URL -> путь относительно каталога книги."""
+        with self.lock:
+            futures = list(self.futures.items())
+        return {url: future.result() for url, future in futures if future.done() and future.result()}
+
+    def _fetch(self, url):
+        try:
+            with metrics.timer('image'):
+                return self._save(url)
+        finally:
+            metrics.track('image_queue', -1)
+
+    async def _async_fetch(self, session, url):
+        try:
+            with metrics.timer('image'):
+                try:
+                    body, _ = await async_fetch_url(session, url, revalidate=False)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    metrics.count('image_errors')
+                    log.error("Ошибка загрузки изображения %s: %r", url, e)
+                    return None
+                # Пережатие и запись файла идут в потоке, чтобы не останавливать цикл событий
+                return await asyncio.get_running_loop().run_in_executor(None, self._store, url, body)
+        finally:
+            metrics.track('image_queue', -1)
+
+    def _save(self, url):
+        try:
+            body, _ = fetch_url(url, revalidate=False)
+        except requests.RequestException as e:
+            metrics.count('image_errors')
+            log.error("Ошибка загрузки изображения %s: %s", url, e)
+            return None
+        return self._store(url, body)
+
+    def _store(self, url, body):
+        body, extension = self._recompress(body, url)
+        relative_path = f"{self.subdir}/{hashlib.sha256(body).hexdigest()[:32]}{extension}"
+        filepath = os.path.join(self.output_dir, relative_path)
+        if not os.path.exists(filepath):
+            makedirs_durably(os.path.dirname(filepath))
+            tmp_path = f"{filepath}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(body)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, filepath)
+            # Журнал ссылается на файл только после того, как он сам и его имя на диске
+            fsync_dir(os.path.dirname(filepath))
+            log.debug("Изображение сохранено в %s", filepath)
+        if self.checkpoint:
+            self.checkpoint.record(image=url, path=relative_path)
+        return relative_path
+
+    def _recompress(self, body, url):
+        extension = os.path.splitext(urllib.parse.urlparse(url).path)[1].lower()
+        if extension not in ('.jpg', '.jpeg', '.png', '.gif', '.webp'):
+            extension = '.jpg'
+        if not (self.max_size or self.quality) or PILImage is None:
+            return body, extension
+        try:
+            image = PILImage.open(io.BytesIO(body))
+            if self.max_size:
+                image.thumbnail((self.max_size, self.max_size))
+            output = io.BytesIO()
+            if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+                # JPEG не хранит прозрачность: прозрачные разделители и баннеры остаются PNG
+                image.save(output, 'PNG', optimize=True)
+                output_extension = '.png'
+            else:
+                if image.mode not in ('RGB', 'L'):
+                    image = image.convert('RGB')
+                image.save(output, 'JPEG', quality=self.quality or 85, optimize=True)
+                output_extension = '.jpg'
+        except (OSError, ValueError) as e:
+            log.warning("Не удалось пережать изображение %s: %s", url, e)
+            return body, extension
+        # Пережатый файл не должен оказаться больше исходного
+        if output.tell() >= len(body) and not self.max_size:
+            return body, extension
+        return output.getvalue(), output_extension
+
+def extract_story_metadata(soup):
     metadata = {}
     
     # Извлечение названия
@@ -95,10 +642,9 @@ def parse_story_metadata(soup, output_dir):
                 elif i == 1:
                     stats['votes'] = value
     
-    # Извлечение и скачивание обложки
+    # Извлечение обложки
     cover_tag = soup.find('div', class_='coverWrapper__t2Ve8').find('img', class_='cover__BlyZa') if soup.find('div', class_='coverWrapper__t2Ve8') else None
     metadata['cover_url'] = cover_tag['src'] if cover_tag and 'src' in cover_tag.attrs else None
-    metadata['cover_path'] = download_image(metadata['cover_url'], output_dir, "cover.jpg") if metadata['cover_url'] else None
     
     metadata['stats'] = stats
     return metadata
@@ -111,21 +657,22 @@ def parse_chapter_list(soup):
             chapter_link = li.find('a', href=re.compile(r'/[0-9]+-'))
             if chapter_link:
                 chapter_url = chapter_link['href']
-                if not chapter_url.startswith('https://'):
+                if not chapter_url.startswith(('http://', 'https://')):
                     chapter_url = 'https://www.wattpad.com' + chapter_url
                 chapter_title = clean_xml_string(chapter_link.find('div').text.strip() if chapter_link.find('div') else "Без названия")
                 chapters.append({'title': chapter_title, 'url': chapter_url})
     return chapters
 
-def parse_chapter_content(soup, chapter_index, output_dir):
+def extract_chapter_content(soup, chapter_index):
+    """Извлекает текст и ссылки на изображения главы без скачивания изображений."""
     content_div = soup.find('div', class_='panel-reading')
-    content = []
+    items = []
     image_counter = 1
     if content_div:
-        print(f"DEBUG: Найден <div class='panel-reading'> для главы {chapter_index}")
+        log.debug("Найден <div class='panel-reading'> для главы %s", chapter_index)
         pre_tag = content_div.find('pre')
         if pre_tag:
-            print(f"DEBUG: Найден <pre> в главе {chapter_index}")
+            log.debug("Найден <pre> в главе %s", chapter_index)
             # Парсим <p> и <figure> последовательно
             for element in pre_tag.find_all(['p', 'figure'], recursive=False):
                 if element.name == 'p':
@@ -133,46 +680,88 @@ def parse_chapter_content(soup, chapter_index, output_dir):
                     for unwanted in element.find_all(['button', 'div'], class_=re.compile(r'comment-marker|component-wrapper')):
                         unwanted.decompose()
                     text = clean_xml_string(element.get_text(strip=True))
-                    print(f"DEBUG: Текст из <p> (data-p-id={element.get('data-p-id', 'N/A')}): {text[:100]}...")
+                    log.debug("Текст из <p> (data-p-id=%s): %s...", element.get('data-p-id', 'N/A'), text[:100])
                     if text:
-                        content.append({'type': 'text', 'value': text})
+                        items.append({'type': 'text', 'value': text, 'pid': element.get('data-p-id')})
                 elif element.name == 'figure':
                     img_tag = element.find('img')
                     if img_tag and 'src' in img_tag.attrs:
                         img_url = img_tag['src']
                         img_alt = clean_xml_string(img_tag.get('alt', ''))
-                        print(f"DEBUG: Изображение найдено в <figure>: {img_url}, alt: {img_alt}")
-                        img_filename = f"chapter_{chapter_index}_image_{image_counter}.jpg"
-                        img_path = download_image(img_url, output_dir, img_filename)
-                        if img_path:
-                            content.append({'type': 'image', 'path': os.path.basename(img_path), 'alt': img_alt})
-                            image_counter += 1
+                        log.debug("Изображение найдено в <figure>: %s, alt: %s", img_url, img_alt)
+                        items.append({'type': 'image', 'url': img_url, 'alt': img_alt})
+                        image_counter += 1
         else:
-            print(f"DEBUG: <pre> не найден, ищем <p> и <img> в главе {chapter_index}")
+            log.debug("<pre> не найден, ищем <p> и <img> в главе %s", chapter_index)
             # Обрабатываем <p> и <img> в <div class="panel-reading">
             for element in content_div.find_all(['p', 'img'], recursive=False):
                 if element.name == 'p':
                     for unwanted in element.find_all(['button', 'div'], class_=re.compile(r'comment-marker|component-wrapper')):
                         unwanted.decompose()
                     text = clean_xml_string(element.get_text(strip=True))
-                    print(f"DEBUG: Текст из <p>: {text[:100]}...")
+                    log.debug("Текст из <p>: %s...", text[:100])
                     if text:
-                        content.append({'type': 'text', 'value': text})
+                        items.append({'type': 'text', 'value': text, 'pid': element.get('data-p-id')})
                 elif element.name == 'img' and 'src' in element.attrs:
                     img_url = element['src']
                     img_alt = clean_xml_string(element.get('alt', ''))
-                    print(f"DEBUG: Изображение найдено: {img_url}, alt: {img_alt}")
-                    img_filename = f"chapter_{chapter_index}_image_{image_counter}.jpg"
-                    img_path = download_image(img_url, output_dir, img_filename)
-                    if img_path:
-                        content.append({'type': 'image', 'path': os.path.basename(img_path), 'alt': img_alt})
-                        image_counter += 1
+                    log.debug("Изображение найдено: %s, alt: %s", img_url, img_alt)
+                    items.append({'type': 'image', 'url': img_url, 'alt': img_alt})
+                    image_counter += 1
         
-        print(f"DEBUG: Найдено {image_counter-1} изображений в главе {chapter_index}")
-        if not content:
-            print(f"DEBUG: Содержимое <div class='panel-reading'>: {str(content_div)[:200]}...")
+        log.debug("Найдено %s изображений в главе %s", image_counter-1, chapter_index)
+        if not items and log.isEnabledFor(logging.DEBUG):
+            log.debug("Содержимое <div class='panel-reading'>: %s...", str(content_div)[:200])
     else:
-        print(f"DEBUG: <div class='panel-reading'> не найден в главе {chapter_index}")
+        log.debug("<div class='panel-reading'> не найден в главе %s", chapter_index)
+    return items
+
+def chapter_page_url(chapter_url, page_number):
+    return f"{chapter_url.rstrip('/')}/page/{page_number}"
+
+def chapter_page_count(body, chapter_url):
+    """Число страниц главы: по ссылкам <адрес главы>/page/N или полю "pages" объекта этой же части в данных страницы."""
+    path = urllib.parse.urlparse(chapter_url).path.rstrip('/')
+    pages = [int(n) for n in re.findall(re.escape(path.encode('utf-8')) + rb'/page/(\d+)', body)]
+    if not pages:
+        # "pages" учитывается, только если стоит в одном JSON-объекте с "id" текущей части
+        part = re.escape(part_id(chapter_url).encode('utf-8'))
+        id_field = rb'"id"\s*:\s*"?' + part + rb'"?[,}\s]'
+        pages_field = rb'"pages"\s*:\s*(\d+)'
+        match = (re.search(id_field + rb'[^{}]*?' + pages_field, body)
+                 or re.search(pages_field + rb'[^{}]*?' + id_field, body))
+        pages = [int(match.group(1))] if match else []
+    page_count = max([1] + pages)
+    if page_count > MAX_CHAPTER_PAGES:
+        log.warning("У главы %s указано страниц: %s, загружаются первые %s", chapter_url, page_count, MAX_CHAPTER_PAGES)
+        page_count = MAX_CHAPTER_PAGES
+    return page_count
+
+def merge_chapter_pages(pages_items):
+    """Склеивает элементы страниц главы по порядку, убирая повторы абзацев по data-p-id."""
+    merged = []
+    seen = set()
+    for items in pages_items:
+        for item in items:
+            if item['type'] == 'text' and item.get('pid'):
+                if item['pid'] in seen:
+                    continue
+                seen.add(item['pid'])
+            merged.append(item)
+    return merged
+
+def finish_chapter_content(items, image_path):
+    """Собирает итоговое содержимое главы; image_path(url) возвращает путь к готовому изображению."""
+    content = []
+    for item in items:
+        if item['type'] == 'text':
+            content.append({'type': 'text', 'value': item['value']})
+        elif 'path' in item:
+            content.append(item)
+        else:
+            path = image_path(item['url'])
+            if path:
+                content.append({'type': 'image', 'path': path, 'alt': item['alt']})
     return content if content else [{'type': 'text', 'value': "Текст главы отсутствует"}]
 
 def parse_chapter_stats(soup):
@@ -190,18 +779,714 @@ def parse_chapter_stats(soup):
             stats['comments'] = int(re.sub(r'\D', '', comments_span.get_text(strip=True)) or 0)
     return stats
 
-def process_chapter(chapter, index, output_dir):
-    chapter_html = get_page_content(chapter['url'])
-    if chapter_html:
-        chapter_soup = BeautifulSoup(chapter_html, 'html.parser')
-        content = parse_chapter_content(chapter_soup, index + 1, output_dir)
-        stats = parse_chapter_stats(chapter_soup)
-        return {'title': chapter['title'], 'url': chapter['url'], 'content': content, 'stats': stats, 'index': index}
+class SoupParser:
+    """Разбор страниц через BeautifulSoup (встроенный html.parser)."""
+
+    name = 'html.parser'
+
+    def parse(self, html):
+        return BeautifulSoup(html, 'html.parser')
+
+    def story_metadata(self, doc):
+        return extract_story_metadata(doc)
+
+    def chapter_list(self, doc):
+        return parse_chapter_list(doc)
+
+    def chapter_content(self, doc, chapter_index):
+        return extract_chapter_content(doc, chapter_index)
+
+    def chapter_stats(self, doc):
+        return parse_chapter_stats(doc)
+
+def _has_class(name):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+def _first(element, xpath):
+    found = element.xpath(xpath) if element is not None else []
+    return found[0] if found else None
+
+def _text(element):
+    return ''.join(element.itertext())
+
+def _stripped_text(element):
+    # Аналог get_text(strip=True) из BeautifulSoup
+    return ''.join(part.strip() for part in element.itertext())
+
+def _number(element):
+    return int(re.sub(r'\D', '', _stripped_text(element)) or 0)
+
+class LxmlParser:
+    """Разбор страниц напрямую через lxml.html и XPath, без дерева BeautifulSoup.
+
+    Выдаёт те же словари, что и SoupParser. libxml2 закрывает <p> перед
+    вложенным <div>, поэтому содержимое между таким абзацем и следующим
+    <p>/<figure> приписывается абзацу, как это делает html.parser.
+
+    Это эвристика: по дереву libxml2 не отличить <div>, вложенный в <p>,
+    от соседнего, а таблицы и вложенные <p> он перестраивает иначе, поэтому
+    на такой разметке результат расходится с html.parser (случаи собраны в
+    PARSER_EDGE_CASES в wattpad-bench.py).
+    """
+
+    name = 'lxml'
+    unwanted_class = re.compile(r'comment-marker|component-wrapper')
+    # Блоки, перед которыми libxml2 закрывает открытый <p>
+    closes_paragraph = {'div', 'ul', 'ol', 'dl', 'table', 'blockquote', 'pre', 'hr', 'form', 'fieldset',
+                        'address', 'center', 'menu', 'dir', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+
+    def parse(self, html):
+        if isinstance(html, str):
+            html = html.encode('utf-8')
+        try:
+            return lxml.html.document_fromstring(html, parser=lxml.html.HTMLParser(encoding='utf-8'))
+        except lxml.etree.ParserError:
+            return lxml.html.document_fromstring(b'<html></html>')
+
+    def story_metadata(self, doc):
+        metadata = {}
+        title_tag = _first(doc, f"//div[{_has_class('gF-N5')}]")
+        metadata['title'] = clean_xml_string(_text(title_tag).strip() if title_tag is not None else "Без названия")
+        author_tag = _first(doc, "//a[contains(@href, '/user/')]")
+        metadata['author'] = clean_xml_string(_text(author_tag).strip() if author_tag is not None else "Неизвестный автор")
+
+        wrapper = _first(doc, f"//div[{_has_class('glL-c')}]")
+        description_tag = _first(wrapper, ".//pre[@class='mpshL _6pPkw']")
+        if description_tag is not None:
+            for copyright in description_tag.xpath(f".//div[{_has_class('DxZKg')}]"):
+                copyright.drop_tree()
+            metadata['description'] = clean_xml_string(_stripped_text(description_tag))
+        else:
+            metadata['description'] = "Описание отсутствует"
+
+        tags = []
+        tags_container = _first(doc, f"//div[{_has_class('F8LJw')}]")
+        if tags_container is not None:
+            for tag in tags_container.xpath(f".//a[{_has_class('XZbAz')}]"):
+                tag_text = _first(tag, f".//span[{_has_class('typography-label-small-semi')}]")
+                if tag_text is not None:
+                    tags.append(clean_xml_string(_text(tag_text).strip()))
+        metadata['tags'] = ', '.join(tags) if tags else "Теги отсутствуют"
+
+        stats = {'views': 0, 'votes': 0, 'chapters': 0}
+        stats_container = _first(doc, f"//ul[{_has_class('n0iXe')}]")
+        if stats_container is not None:
+            for i, stat in enumerate(stats_container.xpath(f".//li[{_has_class('_0jt-y')}]")):
+                stat_value = _first(stat, ".//div[@data-tip]")
+                if stat_value is not None:
+                    value = int(re.sub(r'\D', '', stat_value.get('data-tip')) or 0)
+                    if i == 0:
+                        stats['views'] = value
+                    elif i == 1:
+                        stats['votes'] = value
+
+        cover_wrapper = _first(doc, f"//div[{_has_class('coverWrapper__t2Ve8')}]")
+        cover_tag = _first(cover_wrapper, f".//img[{_has_class('cover__BlyZa')}]")
+        metadata['cover_url'] = cover_tag.get('src') if cover_tag is not None else None
+        metadata['stats'] = stats
+        return metadata
+
+    def chapter_list(self, doc):
+        chapters = []
+        toc = _first(doc, "//div[@data-testid='toc']")
+        if toc is not None:
+            for li in toc.iter('li'):
+                chapter_link = next((a for a in li.iter('a') if re.search(r'/[0-9]+-', a.get('href', ''))), None)
+                if chapter_link is not None:
+                    chapter_url = chapter_link.get('href')
+                    if not chapter_url.startswith(('http://', 'https://')):
+                        chapter_url = 'https://www.wattpad.com' + chapter_url
+                    title_div = _first(chapter_link, ".//div")
+                    chapter_title = clean_xml_string(_text(title_div).strip() if title_div is not None else "Без названия")
+                    chapters.append({'title': chapter_title, 'url': chapter_url})
+        return chapters
+
+    def _paragraph_parts(self, element):
+        """Текст элемента без маркеров комментариев, по частям."""
+        if element.tag in ('button', 'div') and self.unwanted_class.search(element.get('class', '')):
+            return []
+        parts = [element.text or '']
+        for child in element:
+            if not isinstance(child.tag, str):
+                parts.append(child.tail or '')
+                continue
+            parts.extend(self._paragraph_parts(child))
+            parts.append(child.tail or '')
+        return parts
+
+    def chapter_content(self, doc, chapter_index):
+        content_div = _first(doc, f"//div[{_has_class('panel-reading')}]")
+        items = []
+        image_counter = 1
+        if content_div is None:
+            log.debug("<div class='panel-reading'> не найден в главе %s", chapter_index)
+            return items
+        pre_tag = _first(content_div, ".//pre")
+        container, image_tag = (pre_tag, 'figure') if pre_tag is not None else (content_div, 'img')
+        paragraph = None
+        paragraph_pid = None
+        continued = False
+
+        def flush():
+            if paragraph is not None:
+                text = clean_xml_string(''.join(part.strip() for part in paragraph))
+                if text:
+                    items.append({'type': 'text', 'value': text, 'pid': paragraph_pid})
+
+        for element in container:
+            if element.tag == 'p':
+                flush()
+                paragraph = self._paragraph_parts(element)
+                paragraph_pid = element.get('data-p-id')
+                continued = False
+            elif element.tag == image_tag:
+                flush()
+                paragraph = None
+                img_tag = element if image_tag == 'img' else _first(element, ".//img")
+                if img_tag is not None and img_tag.get('src') is not None:
+                    items.append({'type': 'image', 'url': img_tag.get('src'), 'alt': clean_xml_string(img_tag.get('alt', ''))})
+                    image_counter += 1
+            elif paragraph is not None and isinstance(element.tag, str) and (continued or element.tag in self.closes_paragraph):
+                # Продолжение абзаца, закрытого парсером перед вложенным блоком
+                continued = True
+                paragraph.extend(self._paragraph_parts(element))
+                paragraph.append(element.tail or '')
+        flush()
+        log.debug("Найдено %s изображений в главе %s", image_counter-1, chapter_index)
+        return items
+
+    def chapter_stats(self, doc):
+        stats = {'views': 0, 'votes': 0, 'comments': 0}
+        stats_container = _first(doc, f"//div[{_has_class('story-stats')}]")
+        if stats_container is not None:
+            reads_span = _first(stats_container, f".//span[{_has_class('reads')}]")
+            if reads_span is not None:
+                stats['views'] = _number(reads_span)
+            votes_span = _first(stats_container, f".//span[{_has_class('votes')}]")
+            if votes_span is not None:
+                stats['votes'] = _number(votes_span)
+            comments_span = _first(doc, "//span[@class='comments on-comments']")
+            if comments_span is not None:
+                stats['comments'] = _number(comments_span)
+        return stats
+
+PARSER_BACKENDS = {'html.parser': SoupParser}
+if lxml is not None:
+    PARSER_BACKENDS['lxml'] = LxmlParser
+
+_parser = SoupParser()
+
+def get_parser(name='html.parser'):
+    if name not in PARSER_BACKENDS:
+        raise RuntimeError(f"Парсер {name} недоступен; установите его: pip install {name}")
+    return PARSER_BACKENDS[name]()
+
+def configure_parser(name='html.parser'):
+    global _parser
+    _parser = get_parser(name)
+
+def parse_chapter_html(chapter_html, chapter_index):
+    doc = _parser.parse(chapter_html)
+    return _parser.chapter_content(doc, chapter_index), _parser.chapter_stats(doc)
+
+def parse_chapter_page(body, encoding, chapter_index):
+    """Разбирает загруженную главу; выполняется в пуле процессов, если он включён."""
+    return parse_chapter_html(decode_page(body, encoding), chapter_index)
+
+# Изображение в тексте главы из API приходит отдельным абзацем: <p ...><img ...></p>
+STORYTEXT_IMAGE = re.compile(r'<p\b[^>]*>\s*(<img\b[^>]*>)\s*(?:<br\s*/?>\s*)?</p>', re.IGNORECASE)
+
+def parse_storytext_page(body, encoding, chapter_index):
+    """Разбирает текст главы из /apiv2/storytext — фрагмент из абзацев без разметки страницы.
+
+    Фрагмент оборачивается в <div class="panel-reading">, поэтому абзацы и
+    изображения извлекает тот же парсер, что и для HTML-страниц; статистика
+    главы берётся из оглавления API.
+    """
+    fragment = STORYTEXT_IMAGE.sub(r'\1', decode_page(body, encoding))
+    doc = _parser.parse(f'<div class="panel-reading">{fragment}</div>')
+    return _parser.chapter_content(doc, chapter_index), None
+
+def site_root(url):
+    parsed = urllib.parse.urlparse(url)
+    return f"{parsed.scheme}://{parsed.netloc}"
+
+def story_api_url(story_url):
+    match = re.search(r'/story/(\d+)', story_url)
+    return f"{site_root(story_url)}/api/v3/stories/{match.group(1)}?fields={API_STORY_FIELDS}" if match else None
+
+def storytext_url(chapter_url, part_id):
+    return f"{site_root(chapter_url)}/apiv2/storytext?id={part_id}"
+
+def _count(value):
+    return int(value or 0)
+
+def parse_story_api(body, encoding, story_url):
+    """Метаданные и оглавление из ответа /api/v3/stories в тех же словарях, что и при разборе HTML."""
+    story = json.loads(decode_page(body, encoding))
+    metadata = {
+        'title': clean_xml_string(story.get('title') or "Без названия"),
+        'author': clean_xml_string((story.get('user') or {}).get('name') or "Неизвестный автор"),
+        'description': clean_xml_string((story.get('description') or '').strip() or "Описание отсутствует"),
+        'tags': ', '.join(clean_xml_string(tag) for tag in story.get('tags') or []) or "Теги отсутствуют",
+        'cover_url': story.get('cover') or None,
+        'stats': {'views': _count(story.get('readCount')), 'votes': _count(story.get('voteCount')), 'chapters': 0},
+    }
+    chapters = []
+    for part in story.get('parts') or []:
+        chapter_url = urllib.parse.urljoin(story_url, part['url'])
+        chapters.append({
+            'title': clean_xml_string(part.get('title') or "Без названия"),
+            'url': chapter_url,
+            'text_url': storytext_url(chapter_url, part['id']),
+            'stats': {'views': _count(part.get('readCount')), 'votes': _count(part.get('voteCount')),
+                      'comments': _count(part.get('commentCount'))},
+            # Признак изменения главы для --sync: меняется при каждой правке автором
+            'version': f"{part['modifyDate']}/{part.get('length')}" if part.get('modifyDate') else None,
+        })
+    return metadata, chapters
+
+def fetch_story_api(story_url, cookies=None):
+    """Загружает историю через JSON API: (метаданные, главы) или None, если нужен HTML."""
+    api_url = story_api_url(story_url)
+    page = fetch_page(api_url, cookies=cookies) if api_url else None
+    if not page:
+        return None
+    try:
+        metadata, chapters = parse_story_api(*page, story_url)
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        log.warning("Неожиданный ответ API для %s: %r", story_url, e)
+        return None
+    return (metadata, chapters) if chapters else None
+
+def part_id(chapter_url):
+    match = re.search(r'/(\d+)-', urllib.parse.urlparse(chapter_url).path)
+    return match.group(1) if match else chapter_url
+
+def apply_api_versions(story_url, chapters, cookies=None):
+    """Дополняет главы из HTML признаками изменения из оглавления API; False, если API недоступен."""
+    api_url = story_api_url(story_url)
+    if not api_url:
+        return False
+    try:
+        _, api_chapters = parse_story_api(*fetch_url(api_url, cookies=cookies), story_url)
+    except (requests.RequestException, ValueError, KeyError, TypeError, AttributeError) as e:
+        log.debug("Оглавление API для %s недоступно: %r", story_url, e)
+        return False
+    versions = {part_id(chapter['url']): chapter['version'] for chapter in api_chapters}
+    for chapter in chapters:
+        chapter['version'] = versions.get(part_id(chapter['url']))
+    return any(versions.values())
+
+def fetch_story_html(story_url, cookies=None):
+    """Загружает страницу истории: (метаданные, главы) или None, если страница недоступна."""
+    html_content = get_page_content(story_url, cookies=cookies)
+    if not html_content:
+        return None
+    doc = _parser.parse(html_content)
+    return _parser.story_metadata(doc), _parser.chapter_list(doc)
+
+_parse_pool = None
+
+def configure_parse_pool(processes, parser_name='html.parser'):
+    """Запускает пул процессов для разбора глав (0 — разбор в потоках загрузки)."""
+    global _parse_pool
+    if _parse_pool:
+        _parse_pool.shutdown()
+    _parse_pool = ProcessPoolExecutor(max_workers=processes, initializer=configure_parser,
+                                      initargs=(parser_name,)) if processes else None
+
+def parse_chapter_in_pool(page, chapter_index, parse=parse_chapter_page):
+    with metrics.timer('parse'):
+        if not _parse_pool:
+            return parse(*page, chapter_index)
+        metrics.track('parse_queue', 1)
+        try:
+            return _parse_pool.submit(parse, *page, chapter_index).result()
+        finally:
+            metrics.track('parse_queue', -1)
+
+def fetch_chapter_items(chapter, index):
+    """Загружает все страницы главы: страницы 2..N качаются, пока разбирается первая."""
+    page = fetch_page(chapter['url'])
+    if not page:
+        return None, None
+    page_count = chapter_page_count(page[0], chapter['url'])
+    if page_count == 1:
+        return parse_chapter_in_pool(page, index + 1)
+    urls = [chapter_page_url(chapter['url'], n) for n in range(2, page_count + 1)]
+    pool = _page_pool
+    extra_pages = [pool.submit(fetch_page, url) for url in urls] if pool else None
+    items, stats = parse_chapter_in_pool(page, index + 1)
+    pages_items = [items]
+    for page_number, url in enumerate(urls, 2):
+        extra_page = extra_pages[page_number - 2].result() if extra_pages else fetch_page(url)
+        if extra_page:
+            pages_items.append(parse_chapter_in_pool(extra_page, index + 1)[0])
+        else:
+            log.warning("Страница %s главы %s не загружена, глава будет неполной", page_number, index + 1)
+    return merge_chapter_pages(pages_items), stats
+
+def fetch_storytext_items(chapter, index):
+    """Загружает текст главы через API одним запросом; (None, None), если нужен HTML."""
+    page = fetch_page(chapter['text_url'])
+    if page:
+        items, _ = parse_chapter_in_pool(page, index + 1, parse_storytext_page)
+        if items:
+            return items, chapter['stats']
+    metrics.count('api_fallbacks')
+    log.warning("Текст главы %s не получен через API, загружается HTML-страница", index + 1)
+    return None, None
+
+_page_pool = None
+
+def configure_page_pool(workers=MAX_WORKERS):
+    """Общий пул загрузки страниц 2..N многостраничных глав (0 — страницы качаются в потоке главы)."""
+    global _page_pool
+    if _page_pool:
+        _page_pool.shutdown()
+    _page_pool = ThreadPoolExecutor(max_workers=workers) if workers else None
+
+_image_pool = None
+
+def configure_image_pool(workers=MAX_WORKERS):
+    """Общий пул загрузки изображений для всех историй (0 — остановить пул)."""
+    global _image_pool
+    if _image_pool:
+        _image_pool.shutdown()
+    _image_pool = ThreadPoolExecutor(max_workers=workers) if workers else None
+
+def queue_chapter_images(items, image_store):
+    # Изображения качаются в фоне; содержимое главы достраивает StoryJob
+    for item in items:
+        if item['type'] == 'image':
+            image_store.submit(item['url'])
+
+def async_queue_chapter_images(session, items, image_store):
+    for item in items:
+        if item['type'] == 'image':
+            image_store.submit_async(session, item['url'])
+
+def process_chapter(chapter, index, image_store):
+    items, stats = fetch_storytext_items(chapter, index) if 'text_url' in chapter else (None, None)
+    if items is None:
+        items, stats = fetch_chapter_items(chapter, index)
+    if items is not None:
+        queue_chapter_images(items, image_store)
+        return {'title': chapter['title'], 'url': chapter['url'], 'content': items, 'stats': stats, 'index': index}
     return None
 
-def save_to_markdown(metadata, chapters_data, output_file):
-    output_dir = os.path.dirname(output_file) or "."
-    with open(output_file, 'w', encoding='utf-8') as f:
+def load_stored_chapter(path, index):
+    """Читает главу из хранилища; None, если файл повреждён или пропал — тогда глава загружается заново."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            chapter_data = json.load(f)
+    except (OSError, ValueError) as e:
+        metrics.count('store_errors')
+        log.warning("Сохранённая глава %s не читается (%s), глава загружается заново", index + 1, e)
+        # Иначе store_chapter оставит повреждённый файл: имя по хешу у перезагруженной главы то же
+        with contextlib.suppress(OSError):
+            os.remove(path)
+        return None
+    metrics.count('chapters_from_store')
+    chapter_data['index'] = index
+    return chapter_data
+
+def run_chapter_task(job, chapter, index, stored_path):
+    chapter_data = load_stored_chapter(stored_path, index) if stored_path else None
+    return chapter_data or process_chapter(chapter, index, job.image_store)
+
+def download_chapters_threaded(tasks, max_workers=MAX_WORKERS, window=None):
+    """Выполняет задачи глав (история, индекс, глава, файл сохранённой главы) в общем пуле.
+
+    Результаты отдаются в job.add строго в порядке задач, поэтому главы
+    каждой истории приходят по порядку. Одновременно в работе не больше
+    window глав: готовые главы ждут в очереди фьючерсов, пока не завершатся
+    предыдущие, поэтому память ограничена окном.
+    """
+    window = window or max_workers * 4
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for job, i, chapter, stored_path in tasks:
+            in_flight.append((job, executor.submit(run_chapter_task, job, chapter, i, stored_path)))
+            metrics.track('chapter_window', 1)
+            if len(in_flight) >= window:
+                job, future = in_flight.popleft()
+                job.add(future.result())
+                metrics.track('chapter_window', -1)
+        while in_flight:
+            job, future = in_flight.popleft()
+            job.add(future.result())
+            metrics.track('chapter_window', -1)
+
+async def async_http_get(session, url, cookies=None, headers=None):
+    """Асинхронный аналог http_get; возвращает (статус, тело, заголовки, кодировка)."""
+    limiter = _rate_limiter
+    for attempt in range(RETRY_ATTEMPTS):
+        throttled = False
+        retry_after = None
+        while wait := limiter.try_acquire():
+            await asyncio.sleep(wait)
+        try:
+            async with session.get(url, cookies=cookies, headers=headers) as response:
+                metrics.count('http_requests')
+                if response.status not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    body = await response.read()
+                    metrics.count('http_bytes', len(body))
+                    return response.status, body, response.headers, response.charset
+                throttled = response.status in THROTTLE_STATUSES
+                metrics.count('http_throttled' if throttled else 'http_server_errors')
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                error = aiohttp.ClientResponseError(response.request_info, response.history,
+                                                    status=response.status, message=response.reason)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            error = e
+        finally:
+            limiter.release(throttled, retry_after)
+        if attempt == RETRY_ATTEMPTS - 1:
+            raise error
+        delay = retry_delay(attempt, retry_after)
+        metrics.count('http_retries')
+        log.warning("Повтор %s/%s для %s через %.1f с: %r", attempt + 1, RETRY_ATTEMPTS - 1, url, delay, error)
+        await asyncio.sleep(delay)
+
+async def async_fetch_url(session, url, cookies=None, revalidate=True):
+    cache = _http_cache
+    entry = cache.lookup(url) if cache else None
+    if entry and not revalidate:
+        body, encoding = cache.load(entry)
+        if body is not None:
+            metrics.count('cache_hits')
+            return body, encoding
+    status, body, headers, encoding = await async_http_get(
+        session, url, cookies=cookies, headers=cache.conditional_headers(entry) if entry else None)
+    if status == 304 and entry:
+        cached_body, cached_encoding = cache.load(entry)
+        if cached_body is not None:
+            metrics.count('cache_hits')
+            return cached_body, cached_encoding
+        status, body, headers, encoding = await async_http_get(session, url, cookies=cookies)
+    if cache:
+        metrics.count('cache_misses')
+        cache.store(url, body, headers.get('ETag'), headers.get('Last-Modified'), encoding)
+    return body, encoding
+
+async def async_fetch_page(session, url, cookies=None):
+    try:
+        with metrics.timer('fetch'):
+            page = await async_fetch_url(session, url, cookies=cookies)
+        log.debug("Успешно загружена страница: %s", url)
+        return page
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        metrics.count('fetch_errors')
+        log.error("Ошибка загрузки страницы %s: %r", url, e)
+        return None
+
+async def async_fetch_storytext_items(session, chapter, index):
+    page = await async_fetch_page(session, chapter['text_url'])
+    if page:
+        with metrics.timer('parse'):
+            items, _ = await asyncio.get_running_loop().run_in_executor(
+                _parse_pool, parse_storytext_page, *page, index + 1)
+        if items:
+            return items, chapter['stats']
+    metrics.count('api_fallbacks')
+    log.warning("Текст главы %s не получен через API, загружается HTML-страница", index + 1)
+    return None, None
+
+async def async_fetch_chapter_items(session, chapter, index):
+    page = await async_fetch_page(session, chapter['url'])
+    if not page:
+        return None, None
+    loop = asyncio.get_running_loop()
+    page_count = chapter_page_count(page[0], chapter['url'])
+    extra_pages = [asyncio.ensure_future(async_fetch_page(session, chapter_page_url(chapter['url'], n)))
+                   for n in range(2, page_count + 1)]
+    # Разбор HTML уходит в пул процессов (или поток), чтобы не останавливать цикл событий
+    with metrics.timer('parse'):
+        items, stats = await loop.run_in_executor(_parse_pool, parse_chapter_page, *page, index + 1)
+    if extra_pages:
+        pages_items = [items]
+        for page_number, task in enumerate(extra_pages, 2):
+            extra_page = await task
+            if extra_page:
+                with metrics.timer('parse'):
+                    pages_items.append((await loop.run_in_executor(_parse_pool, parse_chapter_page, *extra_page, index + 1))[0])
+            else:
+                log.warning("Страница %s главы %s не загружена, глава будет неполной", page_number, index + 1)
+        items = merge_chapter_pages(pages_items)
+    return items, stats
+
+async def async_process_chapter(session, chapter, index, image_store):
+    items, stats = (await async_fetch_storytext_items(session, chapter, index)) if 'text_url' in chapter else (None, None)
+    if items is None:
+        items, stats = await async_fetch_chapter_items(session, chapter, index)
+    if items is None:
+        return None
+    async_queue_chapter_images(session, items, image_store)
+    return {'title': chapter['title'], 'url': chapter['url'], 'content': items, 'stats': stats, 'index': index}
+
+async def async_run_chapter_task(session, job, chapter, index, stored_path):
+    chapter_data = load_stored_chapter(stored_path, index) if stored_path else None
+    return chapter_data or await async_process_chapter(session, chapter, index, job.image_store)
+
+async def download_chapters_async_main(tasks, concurrency, per_host, window):
+    # Общий лимит и лимит на хост обеспечивает пул соединений aiohttp
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=per_host)
+    timeout = aiohttp.ClientTimeout(sock_connect=HTTP_TIMEOUT, sock_read=HTTP_TIMEOUT)
+    in_flight = deque()
+    async with aiohttp.ClientSession(headers=HTTP_HEADERS, connector=connector, timeout=timeout) as session:
+        for job, i, chapter, stored_path in tasks:
+            in_flight.append((job, asyncio.ensure_future(async_run_chapter_task(session, job, chapter, i, stored_path))))
+            metrics.track('chapter_window', 1)
+            if len(in_flight) >= window:
+                job, task = in_flight.popleft()
+                await job.add_async(await task)
+                metrics.track('chapter_window', -1)
+        while in_flight:
+            job, task = in_flight.popleft()
+            await job.add_async(await task)
+            metrics.track('chapter_window', -1)
+
+def download_chapters_async(tasks, concurrency=ASYNC_CONCURRENCY, per_host=ASYNC_PER_HOST, window=None):
+    if aiohttp is None:
+        raise RuntimeError("Для --engine asyncio установите aiohttp: pip install aiohttp")
+    asyncio.run(download_chapters_async_main(tasks, concurrency, per_host, window or concurrency * 2))
+
+def chapter_hash(chapter_data):
+    payload = json.dumps([chapter_data['title'], chapter_data['content'], chapter_data['stats']],
+                         ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def makedirs_durably(path):
+    if not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+        fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+def fsync_dir(path):
+    """Сбрасывает на диск запись каталога (переименование файла); в Windows каталог так не открыть."""
+    if os.name == 'posix':
+        fd = os.open(path or ".", os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def write_json_atomic(path, data):
+    """Записывает JSON через временный файл; после сбоя питания на месте path старый или новый файл целиком."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(os.path.dirname(path))
+
+def load_manifest(output_base):
+    """Манифест прошлого запуска вместе с журналом, если тот запуск был прерван."""
+    try:
+        with open(f"{output_base}.manifest.json", encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {'chapters': {}}
+    manifest.setdefault('image_urls', {})
+    try:
+        with open(f"{output_base}.journal.jsonl", encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Последняя строка могла оборваться при сбое
+                    break
+                if 'chapter' in record:
+                    manifest['chapters'][record['chapter']] = record['entry']
+                elif 'image' in record:
+                    manifest['image_urls'][record['image']] = record['path']
+    except OSError:
+        pass
+    return manifest
+
+class Checkpoint:
+    """Журнал готовой работы истории (<output>.journal.jsonl).
+
+    Каждая сохранённая глава и скачанное изображение дописываются строкой и
+    сразу сбрасываются на диск, поэтому после сбоя --resume продолжает с
+    места остановки. После успешного завершения журнал заменяется манифестом.
+    """
+
+    def __init__(self, output_base, resume=False):
+        self.path = f"{output_base}.journal.jsonl"
+        self.lock = threading.Lock()
+        self.f = open(self.path, 'a' if resume else 'w', encoding='utf-8')
+        fsync_dir(os.path.dirname(self.path))
+
+    def record(self, **entry):
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self.lock:
+            self.f.write(line)
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
+        os.remove(self.path)
+
+def plan_sync(chapters, manifest, output_base, revalidate=True):
+    """Строит план загрузки: (индекс, глава, файл сохранённой главы или None)."""
+    output_dir = os.path.dirname(output_base) or "."
+    plan = []
+    for i, chapter in enumerate(chapters):
+        entry = manifest['chapters'].get(chapter['url'])
+        stored_path = None
+        if entry and entry['index'] == i and entry['title'] == chapter['title']:
+            stored_path = os.path.join(f"{output_base}.chapters", f"{entry['hash']}.json")
+            if not os.path.exists(stored_path) or not all(
+                    os.path.exists(os.path.join(output_dir, image)) for image in entry['images']):
+                stored_path = None
+            # --sync берёт главу из хранилища, только если версия из оглавления API не изменилась
+            elif revalidate and (not chapter.get('version') or chapter['version'] != entry.get('version')):
+                stored_path = None
+            elif chapter.get('version') and entry.get('version') and chapter['version'] != entry['version']:
+                stored_path = None
+        plan.append((i, chapter, stored_path))
+    return plan
+
+def store_chapter(output_base, chapter, manifest, version=None):
+    """Сохраняет разобранную главу и возвращает её запись для манифеста."""
+    store_dir = f"{output_base}.chapters"
+    makedirs_durably(store_dir)
+    digest = chapter_hash(chapter)
+    previous = manifest['chapters'].get(chapter['url'])
+    chapter_file = os.path.join(store_dir, f"{digest}.json")
+    if not os.path.exists(chapter_file):
+        write_json_atomic(chapter_file, chapter)
+    return {
+        'index': chapter['index'],
+        'title': chapter['title'],
+        'hash': digest,
+        'fetched_at': previous['fetched_at'] if previous and previous['hash'] == digest else time.time(),
+        'images': [item['path'] for item in chapter['content'] if item['type'] == 'image'],
+        'version': version,
+    }
+
+def save_manifest(output_base, story_url, entries, image_urls=None):
+    """Сохраняет манифест; в него попадают только главы текущего оглавления."""
+    store_dir = f"{output_base}.chapters"
+    # Удаляем файлы глав, на которые манифест больше не ссылается
+    live = {f"{entry['hash']}.json" for entry in entries.values()}
+    if os.path.isdir(store_dir):
+        for name in os.listdir(store_dir):
+            if name.endswith('.json') and name not in live:
+                os.remove(os.path.join(store_dir, name))
+    write_json_atomic(f"{output_base}.manifest.json",
+                      {'story_url': story_url, 'chapters': entries, 'image_urls': image_urls or {}})
+
+class MarkdownWriter:
+    def __init__(self, output_file, metadata, toc):
+        self.output_file = output_file
+        self.f = open(output_file, 'w', encoding='utf-8')
+        f = self.f
         # Только обложка в начале
         if metadata['cover_path']:
             f.write(f"![Обложка]({os.path.basename(metadata['cover_path'])})\n\n")
@@ -213,26 +1498,31 @@ def save_to_markdown(metadata, chapters_data, output_file):
         f.write(f"**Теги**: {metadata['tags']}\n\n")
         f.write(f"**Статистика**: Просмотры={metadata['stats']['views']}, Голоса={metadata['stats']['votes']}, Главы={metadata['stats']['chapters']}\n\n")
         f.write("## Оглавление\n")
-        for i, chapter in enumerate(chapters_data, 1):
+        for i, chapter in enumerate(toc, 1):
             f.write(f"{i}. [{chapter['title']}]({chapter['url']})\n")
         f.write("\n")
-        
-        # Главы
-        for chapter in chapters_data:
-            if chapter:
-                f.write(f"## {chapter['title']}\n\n")
-                f.write(f"**Статистика главы**: Просмотры={chapter['stats']['views']}, Голоса={chapter['stats']['votes']}, Комментарии={chapter['stats']['comments']}\n\n")
-                for item in chapter['content']:
-                    if item['type'] == 'text':
-                        f.write(f"{item['value']}\n\n")
-                    elif item['type'] == 'image':
-                        f.write(f"![{item['alt']}]({item['path']})\n\n")
-    
-    print(f"Содержимое книги сохранено в {output_file}")
 
-def save_to_txt(metadata, chapters_data, output_file):
-    output_dir = os.path.dirname(output_file) or "."
-    with open(output_file, 'w', encoding='utf-8') as f:
+    def write_chapter(self, chapter):
+        f = self.f
+        f.write(f"## {chapter['title']}\n\n")
+        f.write(f"**Статистика главы**: Просмотры={chapter['stats']['views']}, Голоса={chapter['stats']['votes']}, Комментарии={chapter['stats']['comments']}\n\n")
+        for item in chapter['content']:
+            if item['type'] == 'text':
+                f.write(f"{item['value']}\n\n")
+            elif item['type'] == 'image':
+                f.write(f"![{item['alt']}]({item['path']})\n\n")
+        # Частичный результат доступен, пока загружаются остальные главы
+        f.flush()
+
+    def close(self):
+        self.f.close()
+        log.info("Содержимое книги сохранено в %s", self.output_file)
+
+class TxtWriter:
+    def __init__(self, output_file, metadata, toc):
+        self.output_file = output_file
+        self.f = open(output_file, 'w', encoding='utf-8')
+        f = self.f
         # Только обложка в начале
         if metadata['cover_path']:
             f.write(f"Обложка: {os.path.basename(metadata['cover_path'])}\n\n")
@@ -244,210 +1534,835 @@ def save_to_txt(metadata, chapters_data, output_file):
         f.write(f"Теги: {metadata['tags']}\n\n")
         f.write(f"Статистика: Просмотры={metadata['stats']['views']}, Голоса={metadata['stats']['votes']}, Главы={metadata['stats']['chapters']}\n\n")
         f.write("Оглавление\n")
-        for i, chapter in enumerate(chapters_data, 1):
+        for i, chapter in enumerate(toc, 1):
             f.write(f"{i}. {chapter['title']} ({chapter['url']})\n")
         f.write("\n")
-        
-        # Главы
-        for chapter in chapters_data:
-            if chapter:
-                f.write(f"{chapter['title']}\n\n")
-                f.write(f"Статистика главы: Просмотры={chapter['stats']['views']}, Голоса={chapter['stats']['votes']}, Комментарии={chapter['stats']['comments']}\n\n")
-                for item in chapter['content']:
-                    if item['type'] == 'text':
-                        f.write(f"{item['value']}\n\n")
-                    elif item['type'] == 'image':
-                        f.write(f"Изображение: {item['path']} ({item['alt']})\n\n")
-    
-    print(f"Содержимое книги сохранено в {output_file}")
 
-def save_to_pdf(metadata, chapters_data, output_file):
-    output_dir = os.path.dirname(output_file) or "."
-    # Пытаемся зарегистрировать DejaVuSans из папки font
-    font_name = 'Times-Roman'  # Запасной шрифт
-    font_dir = os.path.join(output_dir, 'font')
-    try:
-        pdfmetrics.registerFont(TTFont('DejaVuSans', os.path.join(font_dir, 'DejaVuSans.ttf')))
-        font_name = 'DejaVuSans'
-        print("Шрифт DejaVuSans успешно зарегистрирован для PDF")
-    except:
-        try:
-            pdfmetrics.registerFont(TTFont('LiberationSerif', os.path.join(font_dir, 'LiberationSerif-Regular.ttf')))
-            font_name = 'LiberationSerif'
-            print("Шрифт LiberationSerif успешно зарегистрирован для PDF")
-        except:
-            print(f"Предупреждение: Файлы шрифтов DejaVuSans.ttf и LiberationSerif-Regular.ttf не найдены в папке {font_dir}. Используется Times-Roman (ограниченная поддержка кириллицы).")
-            print("Скачайте DejaVuSans.ttf или LiberationSerif-Regular.ttf с https://www.fontsquirrel.com/fonts/dejavu-sans или https://www.fontsquirrel.com/fonts/liberation-serif и поместите в папку font.")
-    
-    doc = SimpleDocTemplate(output_file, pagesize=letter)
+    def write_chapter(self, chapter):
+        f = self.f
+        f.write(f"{chapter['title']}\n\n")
+        f.write(f"Статистика главы: Просмотры={chapter['stats']['views']}, Голоса={chapter['stats']['votes']}, Комментарии={chapter['stats']['comments']}\n\n")
+        for item in chapter['content']:
+            if item['type'] == 'text':
+                f.write(f"{item['value']}\n\n")
+            elif item['type'] == 'image':
+                f.write(f"Изображение: {item['path']} ({item['alt']})\n\n")
+        f.flush()
+
+    def close(self):
+        self.f.close()
+        log.info("Содержимое книги сохранено в %s", self.output_file)
+
+def sanitize_book_value(value):
+    """Рекурсивно очищает строки от невалидных XML-символов."""
+    if isinstance(value, str):
+        return clean_xml_string(value)
+    if isinstance(value, dict):
+        return {key: sanitize_book_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [sanitize_book_value(item) for item in value]
+    return value
+
+class BookWriter:
+    """Промежуточное представление книги в JSON Lines (<output>.book.jsonl).
+
+    Первая строка — метаданные и оглавление, далее по строке на главу в
+    порядке книги. Строки уже очищены, поэтому экспортёры используют их
+    как есть; из этого файла любой формат собирается заново без сети.
+    """
+
+    def __init__(self, output_file, metadata, toc):
+        self.output_file = output_file
+        output_dir = os.path.dirname(output_file) or "."
+        metadata = dict(metadata)
+        # Обложка хранится относительно каталога книги, чтобы файл можно было переносить
+        if metadata['cover_path']:
+            metadata['cover_path'] = os.path.relpath(metadata['cover_path'], output_dir)
+        self.f = open(output_file, 'w', encoding='utf-8')
+        self.f.write(json.dumps({'metadata': metadata, 'toc': [{'title': chapter['title'], 'url': chapter['url']} for chapter in toc]},
+                                ensure_ascii=False) + "\n")
+
+    def write_chapter(self, chapter):
+        self.f.write(json.dumps(chapter, ensure_ascii=False) + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+def read_book_header(book_file):
+    """Читает первую строку промежуточного представления: (метаданные, оглавление)."""
+    with open(book_file, encoding='utf-8') as f:
+        header = json.loads(f.readline())
+    metadata = header['metadata']
+    if metadata['cover_path']:
+        metadata['cover_path'] = os.path.join(os.path.dirname(book_file) or ".", metadata['cover_path'])
+    return metadata, header['toc']
+
+def iter_book_chapters(book_file, start=0, stop=None):
+    """Главы промежуточного представления по одной, с start по stop (не включая)."""
+    with open(book_file, encoding='utf-8') as f:
+        f.readline()
+        number = 0
+        for line in f:
+            if not line.strip():
+                continue
+            if stop is not None and number >= stop:
+                break
+            # Строки до start только пропускаются, без разбора JSON
+            if number >= start:
+                yield json.loads(line)
+            number += 1
+
+def load_book(book_file):
+    """Читает промежуточное представление целиком: (метаданные, оглавление, главы)."""
+    metadata, toc = read_book_header(book_file)
+    return metadata, toc, list(iter_book_chapters(book_file))
+
+EPUB_CONTAINER = """<?xml version="1.0" encoding="utf-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles><rootfile full-path="EPUB/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>
+"""
+
+def xhtml_page(title, body):
+    return "".join([
+        '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n',
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="ru" xml:lang="ru">\n',
+        f"<head><title>{html.escape(title)}</title></head>\n<body>\n", body, "\n</body>\n</html>\n",
+    ])
+
+class EpubWriter:
+    """Пишет EPUB 3 прямо в zip-архив по мере поступления глав.
+
+    Главы и изображения сразу попадают в архив и не держатся в памяти;
+    страница оглавления, NCX, nav и OPF дописываются при закрытии, когда
+    известен итоговый список глав. До закрытия архив пишется во временный файл.
+    """
+
+    def __init__(self, output_file, metadata, toc):
+        self.output_file = output_file
+        self.output_dir = os.path.dirname(output_file) or "."
+        self.metadata = metadata
+        self.tmp_path = f"{output_file}.tmp"
+        self.zip = zipfile.ZipFile(self.tmp_path, 'w', zipfile.ZIP_DEFLATED)
+        # mimetype — первый файл архива и без сжатия, этого требует спецификация
+        self.zip.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        self.zip.writestr('META-INF/container.xml', EPUB_CONTAINER)
+        self.chapters = []
+        self.images = {}
+        stats = metadata['stats']
+        self.zip.writestr('EPUB/meta.xhtml', xhtml_page('Метаданные', "\n".join([
+            f'<h1 style="text-align: center;">{html.escape(metadata["title"])}</h1>',
+            f"<p><b>Автор:</b> {html.escape(metadata['author'])}</p>",
+            f"<p><b>Описание:</b> {html.escape(metadata['description'])}</p>",
+            f"<p><b>Теги:</b> {html.escape(metadata['tags'])}</p>",
+            f"<p><b>Статистика:</b> Просмотры={stats['views']}, Голоса={stats['votes']}, Главы={stats['chapters']}</p>",
+        ])))
+
+    def write_chapter(self, chapter):
+        file_name = f"chapter_{chapter['index'] + 1}.xhtml"
+        stats = chapter['stats']
+        body = [
+            f"<h1>{html.escape(chapter['title'])}</h1>",
+            f"<p><b>Статистика главы:</b> Просмотры={stats['views']}, Голоса={stats['votes']}, Комментарии={stats['comments']}</p>",
+        ]
+        for item in chapter['content']:
+            if item['type'] == 'text':
+                body.append(f"<p>{html.escape(item['value'], quote=False)}</p>")
+            elif item['type'] == 'image':
+                self.add_image(item['path'])
+                body.append(f'<p><img src="{html.escape(item["path"])}" alt="{html.escape(item["alt"])}"/></p>')
+        self.zip.writestr(f"EPUB/{file_name}", xhtml_page(chapter['title'], "\n".join(body)))
+        self.chapters.append((file_name, chapter['title']))
+
+    def add_image(self, path):
+        # Каждое уникальное изображение добавляется в книгу один раз
+        if path in self.images:
+            return
+        media_type = mimetypes.guess_type(path)[0] or 'image/jpeg'
+        self.images[path] = media_type
+        # Изображения уже сжаты; файл копируется в архив потоком
+        self.zip.write(os.path.join(self.output_dir, path), f"EPUB/{path}", compress_type=zipfile.ZIP_STORED)
+
+    def close(self):
+        metadata = self.metadata
+        pages = [('meta.xhtml', 'Метаданные'), ('toc.xhtml', 'Оглавление')] + self.chapters
+        links = "".join(f'<li><a href="{name}">{html.escape(title)}</a></li>' for name, title in self.chapters)
+        self.zip.writestr('EPUB/toc.xhtml', xhtml_page('Оглавление',
+            f'<h2 style="page-break-before: always; text-align: center;">Оглавление</h2>\n<ul>{links}</ul>'))
+        nav_items = "".join(f'<li><a href="{name}">{html.escape(title)}</a></li>' for name, title in pages)
+        self.zip.writestr('EPUB/nav.xhtml', xhtml_page(metadata['title'],
+            f'<nav epub:type="toc" id="toc"><h2>{html.escape(metadata["title"])}</h2><ol>{nav_items}</ol></nav>'))
+        identifier = html.escape(f"wattpad_{metadata['title']}")
+        nav_points = "".join(
+            f'<navPoint id="nav_{n}" playOrder="{n}"><navLabel><text>{html.escape(title)}</text></navLabel>'
+            f'<content src="{name}"/></navPoint>'
+            for n, (name, title) in enumerate(pages, 1))
+        self.zip.writestr('EPUB/toc.ncx', "".join([
+            '<?xml version="1.0" encoding="utf-8"?>\n<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">',
+            f'<head><meta name="dtb:uid" content="{identifier}"/></head>',
+            f"<docTitle><text>{html.escape(metadata['title'])}</text></docTitle>",
+            f"<navMap>{nav_points}</navMap></ncx>\n",
+        ]))
+        manifest = ['<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>',
+                    '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>']
+        spine = []
+        for n, (name, _) in enumerate(pages):
+            manifest.append(f'<item id="page_{n}" href="{name}" media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="page_{n}"/>')
+        for n, (path, media_type) in enumerate(self.images.items()):
+            manifest.append(f'<item id="image_{n}" href="{html.escape(path)}" media-type="{media_type}"/>')
+        modified = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        self.zip.writestr('EPUB/content.opf', "\n".join([
+            '<?xml version="1.0" encoding="utf-8"?>',
+            '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id" xml:lang="ru">',
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">',
+            f'<dc:identifier id="id">{identifier}</dc:identifier>',
+            f"<dc:title>{html.escape(metadata['title'])}</dc:title>",
+            "<dc:language>ru</dc:language>",
+            f"<dc:creator>{html.escape(metadata['author'])}</dc:creator>",
+            f'<meta property="dcterms:modified">{modified}</meta>',
+            "</metadata>",
+            f"<manifest>{''.join(manifest)}</manifest>",
+            f'<spine toc="ncx">{"".join(spine)}</spine>',
+            "</package>\n",
+        ]))
+        self.zip.close()
+        os.replace(self.tmp_path, self.output_file)
+        log.info("Содержимое книги сохранено в %s", self.output_file)
+
+def write_book(writer, chapters_data):
+    for chapter in chapters_data:
+        if chapter:
+            writer.write_chapter(chapter)
+    writer.close()
+
+def save_to_markdown(metadata, chapters_data, output_file):
+    write_book(MarkdownWriter(output_file, metadata, chapters_data), chapters_data)
+
+def save_to_txt(metadata, chapters_data, output_file):
+    write_book(TxtWriter(output_file, metadata, chapters_data), chapters_data)
+
+# Начертания шрифтов для PDF: обычный, жирный, курсив, жирный курсив
+PDF_FONTS = [
+    ('DejaVuSans', ['DejaVuSans.ttf', 'DejaVuSans-Bold.ttf', 'DejaVuSans-Oblique.ttf', 'DejaVuSans-BoldOblique.ttf']),
+    ('LiberationSerif', ['LiberationSerif-Regular.ttf', 'LiberationSerif-Bold.ttf',
+                         'LiberationSerif-Italic.ttf', 'LiberationSerif-BoldItalic.ttf']),
+]
+PDF_CHUNK_CHAPTERS = 100
+_pdf_font = None
+_pdf_options = {'chunk_chapters': PDF_CHUNK_CHAPTERS, 'processes': 1}
+
+def register_pdf_font(output_dir):
+    """Регистрирует шрифт с кириллицей один раз на процесс; возвращает (обычный, жирный).
+
+    Шрифты ищутся в папке font рядом с книгой, затем рядом со скриптом.
+    Отсутствующие начертания заменяются обычным.
+    """
+    global _pdf_font
+    if _pdf_font:
+        return _pdf_font
+    font_dirs = [os.path.join(output_dir, 'font'), os.path.join(os.path.dirname(os.path.abspath(__file__)), 'font')]
+    for family, files in PDF_FONTS:
+        for font_dir in font_dirs:
+            if not os.path.exists(os.path.join(font_dir, files[0])):
+                continue
+            try:
+                names = []
+                for suffix, filename in zip(['', '-Bold', '-Oblique', '-BoldOblique'], files):
+                    path = os.path.join(font_dir, filename)
+                    if os.path.exists(path):
+                        pdfmetrics.registerFont(TTFont(family + suffix, path))
+                        names.append(family + suffix)
+                    else:
+                        names.append(family)
+            except Exception as e:
+                log.warning("Не удалось загрузить шрифт %s из %s: %s", family, font_dir, e)
+                continue
+            # Разметка <b> и <i> в абзацах использует зарегистрированные начертания
+            for (bold, italic), name in zip([(0, 0), (1, 0), (0, 1), (1, 1)], names):
+                addMapping(family, bold, italic, name)
+            log.debug("Шрифт %s успешно зарегистрирован для PDF", family)
+            _pdf_font = (names[0], names[1])
+            return _pdf_font
+    log.warning("Файлы шрифтов DejaVuSans.ttf и LiberationSerif-Regular.ttf не найдены в папке %s. Используется Times-Roman (ограниченная поддержка кириллицы).", font_dirs[0])
+    log.warning("Скачайте DejaVuSans.ttf или LiberationSerif-Regular.ttf с https://www.fontsquirrel.com/fonts/dejavu-sans или https://www.fontsquirrel.com/fonts/liberation-serif и поместите в папку font.")
+    _pdf_font = ('Times-Roman', 'Times-Bold')
+    return _pdf_font
+
+def configure_pdf(chunk_chapters=PDF_CHUNK_CHAPTERS, processes=1):
+    """Задаёт размер части PDF в главах и число процессов вёрстки частей."""
+    _pdf_options['chunk_chapters'] = chunk_chapters
+    _pdf_options['processes'] = processes
+
+class PdfBookTemplate(SimpleDocTemplate):
+    """Документ, который добавляет закладку PDF для каждого заголовка главы."""
+
+    def afterFlowable(self, flowable):
+        outline_title = getattr(flowable, 'outline_title', None)
+        if outline_title:
+            key = f"chapter_{flowable.outline_key}"
+            self.canv.bookmarkPage(key)
+            self.canv.addOutlineEntry(outline_title, key, level=0)
+
+def pdf_styles(output_dir):
+    font_name, bold_name = register_pdf_font(output_dir)
     styles = getSampleStyleSheet()
-    styles['Title'].fontName = font_name
+    styles['Title'].fontName = bold_name
     styles['Normal'].fontName = font_name
-    styles['Heading2'].fontName = font_name
+    styles['Heading2'].fontName = bold_name
+    return styles
+
+def pdf_front_matter(metadata, toc, styles):
     story = []
-    
     # Только обложка в начале
     if metadata['cover_path']:
         story.append(Image(metadata['cover_path'], width=200, height=200))
         story.append(Spacer(1, 12))
     
     # Метаданные и оглавление
-    story.append(Paragraph(clean_xml_string(metadata['title']), styles['Title']))
+    story.append(Paragraph(metadata['title'], styles['Title']))
     story.append(Spacer(1, 12))
-    story.append(Paragraph(f"Автор: {clean_xml_string(metadata['author'])}", styles['Normal']))
-    story.append(Paragraph(f"Описание: {clean_xml_string(metadata['description'])}", styles['Normal']))
-    story.append(Paragraph(f"Теги: {clean_xml_string(metadata['tags'])}", styles['Normal']))
+    story.append(Paragraph(f"Автор: {metadata['author']}", styles['Normal']))
+    story.append(Paragraph(f"Описание: {metadata['description']}", styles['Normal']))
+    story.append(Paragraph(f"Теги: {metadata['tags']}", styles['Normal']))
     story.append(Paragraph(f"Статистика: Просмотры={metadata['stats']['views']}, Голоса={metadata['stats']['votes']}, Главы={metadata['stats']['chapters']}", styles['Normal']))
     story.append(Spacer(1, 12))
     story.append(Paragraph("Оглавление", styles['Heading2']))
-    for i, chapter in enumerate(chapters_data, 1):
-        story.append(Paragraph(f"{i}. {clean_xml_string(chapter['title'])}", styles['Normal']))
+    for i, title in enumerate(toc, 1):
+        story.append(Paragraph(f"{i}. {title}", styles['Normal']))
     story.append(Spacer(1, 12))
-    
-    # Главы
+    return story
+
+def pdf_chapter_flowables(chapter, output_dir, styles):
+    heading = Paragraph(chapter['title'], styles['Heading2'])
+    heading.outline_title = chapter['title']
+    heading.outline_key = chapter['index']
+    story = [heading]
+    story.append(Paragraph(f"Статистика главы: Просмотры={chapter['stats']['views']}, Голоса={chapter['stats']['votes']}, Комментарии={chapter['stats']['comments']}", styles['Normal']))
+    story.append(Spacer(1, 12))
+    for item in chapter['content']:
+        if item['type'] == 'text':
+            story.append(Paragraph(item['value'], styles['Normal']))
+            story.append(Spacer(1, 12))
+        elif item['type'] == 'image':
+            img_path = os.path.join(output_dir, item['path'])
+            story.append(Image(img_path, width=200, height=200))
+            if item['alt']:
+                story.append(Paragraph(item['alt'], styles['Normal']))
+            story.append(Spacer(1, 12))
+    return story
+
+def build_pdf_part(part_file, output_dir, chapters_data, metadata=None, toc=None):
+    """Верстает часть книги; титульные страницы и оглавление — только в первой части."""
+    styles = pdf_styles(output_dir)
+    story = pdf_front_matter(metadata, toc, styles) if metadata else []
     for chapter in chapters_data:
         if chapter:
-            story.append(Paragraph(clean_xml_string(chapter['title']), styles['Heading2']))
-            story.append(Paragraph(f"Статистика главы: Просмотры={chapter['stats']['views']}, Голоса={chapter['stats']['votes']}, Комментарии={chapter['stats']['comments']}", styles['Normal']))
-            story.append(Spacer(1, 12))
-            for item in chapter['content']:
-                if item['type'] == 'text':
-                    story.append(Paragraph(clean_xml_string(item['value']), styles['Normal']))
-                    story.append(Spacer(1, 12))
-                elif item['type'] == 'image':
-                    img_path = os.path.join(output_dir, item['path'])
-                    story.append(Image(img_path, width=200, height=200))
-                    if item['alt']:
-                        story.append(Paragraph(clean_xml_string(item['alt']), styles['Normal']))
-                    story.append(Spacer(1, 12))
+            # Каждая глава с новой страницы, поэтому границы частей не видны в книге
+            if story:
+                story.append(PageBreak())
+            story.extend(pdf_chapter_flowables(chapter, output_dir, styles))
+    PdfBookTemplate(part_file, pagesize=letter).build(story)
+    return part_file
+
+def merge_pdf_parts(part_files, output_file):
+    writer = pypdf.PdfWriter()
+    for part_file in part_files:
+        # Закладки глав переносятся вместе со страницами части
+        writer.append(part_file)
+    tmp_path = f"{output_file}.tmp"
+    with open(tmp_path, 'wb') as f:
+        writer.write(f)
+    os.replace(tmp_path, output_file)
+
+def build_book_pdf_part(part_file, book_file, start, stop, metadata=None, toc=None):
+    """Верстает главы start..stop, читая из файла книги только их; выполняется и в пуле процессов."""
+    output_dir = os.path.dirname(part_file) or "."
+    return build_pdf_part(part_file, output_dir, iter_book_chapters(book_file, start, stop), metadata, toc)
+
+def save_book_to_pdf(book_file, output_file):
+    """Собирает PDF из промежуточного представления частями по chunk_chapters глав и склеивает их через pypdf."""
+    output_dir = os.path.dirname(output_file) or "."
+    metadata, _ = read_book_header(book_file)
+    # Первый проход — только названия для оглавления; тексты глав не задерживаются в памяти
+    toc = [chapter['title'] for chapter in iter_book_chapters(book_file)]
+    chunk_chapters = max(1, _pdf_options['chunk_chapters'])
+    ranges = [(start, min(start + chunk_chapters, len(toc))) for start in range(0, len(toc), chunk_chapters)]
+    if len(ranges) <= 1 or pypdf is None:
+        if len(ranges) > 1:
+            log.warning("pypdf не установлен, PDF собирается одним документом (pip install pypdf)")
+        build_pdf_part(output_file, output_dir, iter_book_chapters(book_file), metadata, toc)
+        log.info("Содержимое книги сохранено в %s", output_file)
+        return
     
-    doc.build(story)
-    print(f"Содержимое книги сохранено в {output_file}")
+    parts = [(f"{output_file}.part{n}", book_file, start, stop, metadata if n == 0 else None, toc if n == 0 else None)
+             for n, (start, stop) in enumerate(ranges)]
+    try:
+        processes = min(_pdf_options['processes'], len(parts))
+        if processes > 1:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                futures = [executor.submit(build_book_pdf_part, *part) for part in parts]
+                part_files = [future.result() for future in futures]
+        else:
+            part_files = [build_book_pdf_part(*part) for part in parts]
+        merge_pdf_parts(part_files, output_file)
+    finally:
+        for part in parts:
+            if os.path.exists(part[0]):
+                os.remove(part[0])
+    log.info("Содержимое книги сохранено в %s", output_file)
+
+def save_to_pdf(metadata, chapters_data, output_file):
+    """Собирает PDF из глав в памяти через временный файл книги рядом с output_file."""
+    book_file = f"{output_file}.book.jsonl"
+    writer = BookWriter(book_file, metadata, [chapter for chapter in chapters_data if chapter])
+    try:
+        write_book(writer, chapters_data)
+        save_book_to_pdf(book_file, output_file)
+    finally:
+        os.remove(book_file)
 
 def save_to_epub(metadata, chapters_data, output_file):
-    output_dir = os.path.dirname(output_file) or "."
-    book = epub.EpubBook()
-    book.set_identifier(f"wattpad_{clean_xml_string(metadata['title'])}")
-    book.set_title(clean_xml_string(metadata['title']))
-    book.set_language('ru')
-    book.add_author(clean_xml_string(metadata['author']))
-
-    # Обложка
-    # cover_page = None
-    # if metadata['cover_path']:
-    #     with open(metadata['cover_path'], 'rb') as f:
-    #         book.set_cover('cover.jpg', f.read())
-    #     cover_page = epub.EpubHtml(title='Обложка', file_name='cover_page.xhtml', lang='ru')
-    #     cover_page.content = f'<h1>{clean_xml_string(metadata["title"])}</h1><img src="cover.jpg" alt="Обложка" />'.encode('utf-8')
-    #     book.add_item(cover_page)
-
-    # Метаданные
-    meta_chapter = epub.EpubHtml(title='Метаданные', file_name='meta.xhtml', lang='ru')
-    meta_content = f"""
-    <h1 style="text-align: center;">{clean_xml_string(metadata['title'])}</h1>
-    <p><b>Автор:</b> {clean_xml_string(metadata['author'])}</p>
-    <p><b>Описание:</b> {clean_xml_string(metadata['description'])}</p>
-    <p><b>Теги:</b> {clean_xml_string(metadata['tags'])}</p>
-    <p><b>Статистика:</b> Просмотры={metadata['stats']['views']}, Голоса={metadata['stats']['votes']}, Главы={metadata['stats']['chapters']}</p>
-    """
-    meta_chapter.content = clean_xml_string(meta_content).encode('utf-8')
-    book.add_item(meta_chapter)
-
-    # Оглавление на новой странице
-    toc_chapter = epub.EpubHtml(title='Оглавление', file_name='toc.xhtml', lang='ru')
-    toc_content = f"""
-    <h2 style="page-break-before: always; text-align: center;">Оглавление</h2>
-    <ul>
+    write_book(EpubWriter(output_file, metadata, chapters_data), chapters_data)
+
+# Форматы, которые пишутся по мере загрузки глав, и форматы, которым нужна вся книга
+STREAMING_FORMATS = {'md': MarkdownWriter, 'txt': TxtWriter, 'epub': EpubWriter}
+# Экспортёры, которые сами читают файл книги: (файл книги, выходной файл)
+BOOK_EXPORTERS = {'pdf': save_book_to_pdf}
+EXPORT_FORMATS = ['md', 'txt', 'pdf', 'epub']
+
+def export_book(book_file, fmt, output_file):
+    """Собирает один формат из промежуточного представления книги; возвращает время сборки в секундах."""
+    start = time.perf_counter()
+    if fmt in STREAMING_FORMATS:
+        metadata, toc = read_book_header(book_file)
+        write_book(STREAMING_FORMATS[fmt](output_file, metadata, toc), iter_book_chapters(book_file))
+    else:
+        BOOK_EXPORTERS[fmt](book_file, output_file)
+    return time.perf_counter() - start
+
+_export_pool = None
+
+def configure_export_pool(processes, pdf_chunk_chapters=PDF_CHUNK_CHAPTERS, pdf_processes=1):
+    """Запускает пул процессов экспорта (0 — экспорт в потоке, завершившем историю)."""
+    global _export_pool
+    if _export_pool:
+        _export_pool.shutdown()
+    configure_pdf(pdf_chunk_chapters, pdf_processes)
+    _export_pool = ProcessPoolExecutor(max_workers=processes, initializer=configure_pdf,
+                                       initargs=(pdf_chunk_chapters, pdf_processes)) if processes else None
+
+def submit_export(book_file, fmt, output_file):
+    """Запускает экспорт; форматы собираются параллельно в пуле процессов."""
+    if _export_pool:
+        metrics.track('export_queue', 1)
+        future = _export_pool.submit(export_book, book_file, fmt, output_file)
+        future.add_done_callback(lambda _: metrics.track('export_queue', -1))
+        return future
+    future = Future()
+    try:
+        future.set_result(export_book(book_file, fmt, output_file))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def wait_exports(exports):
+    """Дожидается экспорта; ошибка одного формата не мешает остальным."""
+    failed = 0
+    for fmt, output_file, future in exports:
+        try:
+            metrics.observe(f"export_{fmt}", future.result())
+        except Exception as e:
+            failed += 1
+            log.error("Ошибка экспорта %s в %s: %s", fmt, output_file, e)
+    return failed
+
+
+class StoryJob:
+    """Загрузка одной истории: главы по порядку дописываются во все форматы, хранилище глав и журнал."""
+
+    def __init__(self, story_url, output_base, metadata, chapters, plan, manifest, image_options=None,
+                 formats=None, resume=False):
+        self.story_url = story_url
+        self.output_base = output_base
+        self.output_dir = os.path.dirname(output_base) or "."
+        self.metadata = sanitize_book_value(metadata)
+        self.chapters = chapters
+        self.plan = plan
+        self.manifest = manifest
+        self.manifest_entries = {}
+        self.changed = 0
+        self.image_options = image_options or {}
+        self.resume = resume
+        self.checkpoint = None
+        self.formats = formats or EXPORT_FORMATS
+        self.book_file = f"{output_base}.book.jsonl"
+        self.exports = []
+        self.remaining = len(plan)
+        self.done = set()
+        self.writers = []
+        self.image_store = None
+
+    def start(self):
+        """Открывает выходные файлы; вызывается, когда планировщик берёт историю в работу."""
+        self.writers = open_writers(self.metadata, self.chapters, self.output_base, self.formats)
+        self.checkpoint = Checkpoint(self.output_base, self.resume)
+        known_images = self.manifest['image_urls'] if self.resume else None
+        self.image_store = ImageStore(self.output_dir, _image_pool, known=known_images, checkpoint=self.checkpoint,
+                                      **self.image_options)
+        if not self.remaining:
+            self.finish()
+
+    def add(self, chapter):
+        if chapter:
+            # Ожидание изображений главы, которые ещё качаются в фоне
+            with metrics.timer('image_wait'):
+                chapter['content'] = finish_chapter_content(chapter['content'], self.image_store.path)
+        self.write(chapter)
+
+    async def add_async(self, chapter):
+        """Вариант add для движка asyncio: цикл событий не блокируется ни на изображениях, ни на записи.
+
+        Изображения главы ожидаются как задачи цикла, а запись во все форматы
+        выполняется в потоке.
+        """
+        if chapter:
+            with metrics.timer('image_wait'):
+                urls = {item['url'] for item in chapter['content'] if item['type'] == 'image' and 'path' not in item}
+                paths = {url: await self.image_store.futures[url] for url in urls}
+            chapter['content'] = finish_chapter_content(chapter['content'], paths.get)
+        await asyncio.get_running_loop().run_in_executor(None, self.write, chapter)
+
+    def write(self, chapter):
+        """Дописывает готовую главу (или отмечает ошибку) во все форматы и журнал."""
+        self.remaining -= 1
+        if chapter:
+            # Очистка строк выполняется один раз, дальше все форматы берут готовые значения
+            chapter = sanitize_book_value(chapter)
+            self.done.add(chapter['index'])
+            with metrics.timer('write'):
+                for writer in self.writers:
+                    writer.write_chapter(chapter)
+                previous = self.manifest['chapters'].get(chapter['url'])
+                entry = store_chapter(self.output_base, chapter, self.manifest,
+                                      self.chapters[chapter['index']].get('version'))
+                if previous and previous['hash'] != entry['hash']:
+                    self.changed += 1
+                    metrics.count('chapters_changed')
+                self.manifest_entries[chapter['url']] = entry
+                self.checkpoint.record(chapter=chapter['url'], entry=entry)
+            metrics.count('chapters')
+        else:
+            metrics.count('chapter_errors')
+        if not self.remaining:
+            self.finish()
+
+    def finish(self):
+        for writer in self.writers:
+            writer.close()
+        self.exports = [(fmt, f"{self.output_base}.{fmt}", submit_export(self.book_file, fmt, f"{self.output_base}.{fmt}"))
+                        for fmt in self.formats if fmt in BOOK_EXPORTERS]
+        # Изображения глав из хранилища в этом запуске не запрашивались — их пути берутся из прошлого манифеста
+        image_urls = dict(self.manifest['image_urls'], **self.image_store.saved())
+        save_manifest(self.output_base, self.story_url, self.manifest_entries, image_urls)
+        self.checkpoint.close()
+        log.info("История «%s» (%s):", self.metadata['title'], self.story_url)
+        if self.changed:
+            log.info("Изменено глав с прошлой загрузки: %s", self.changed)
+        report_failed_chapters(self.chapters, self.done)
+
+    def summary(self):
+        """Итог истории для отчёта о запуске."""
+        return {
+            'url': self.story_url,
+            'title': self.metadata['title'],
+            'output': self.output_base,
+            'chapters': len(self.chapters),
+            'downloaded': len(self.done),
+            'failed': [{'index': i + 1, 'title': chapter['title'], 'url': chapter['url']}
+                       for i, chapter in enumerate(self.chapters) if i not in self.done],
+            'formats': self.formats,
+        }
+
+def schedule_stories(jobs, max_active):
+    """Чередует главы историй по кругу, чтобы длинная история не занимала весь пул.
+
+    Одновременно в работе не больше max_active историй: следующая история
+    начинается, когда у одной из активных заканчиваются главы для запуска.
     """
-    for i, chapter in enumerate(chapters_data, 1):
-        toc_content += f"<li><a href='chapter_{i}.xhtml'>{clean_xml_string(chapter['title'])}</a></li>"
-    toc_content += "</ul>"
-    toc_chapter.content = clean_xml_string(toc_content).encode('utf-8')
-    book.add_item(toc_chapter)
-
-    # Главы
-    chapter_items = []
-    for i, chapter in enumerate(chapters_data, 1):
-        chapter_html = epub.EpubHtml(title=clean_xml_string(chapter['title']), file_name=f'chapter_{i}.xhtml', lang='ru')
-        content = f"<h1>{clean_xml_string(chapter['title'])}</h1>"
-        content += f"<p><b>Статистика главы:</b> Просмотры={chapter['stats']['views']}, Голоса={chapter['stats']['votes']}, Комментарии={chapter['stats']['comments']}</p>"
-        for item in chapter['content']:
-            if item['type'] == 'text':
-                content += f"<p>{clean_xml_string(item['value'])}</p>"
-            elif item['type'] == 'image':
-                img_filename = item['path']
-                with open(os.path.join(output_dir, img_filename), 'rb') as f:
-                    img_item = epub.EpubImage()
-                    img_item.file_name = img_filename
-                    img_item.content = f.read()
-                    book.add_item(img_item)
-                content += f"<p><img src='{img_filename}' alt='{clean_xml_string(item['alt'])}' /></p>"
-        chapter_html.content = clean_xml_string(content).encode('utf-8')
-        book.add_item(chapter_html)
-        chapter_items.append(chapter_html)
-
-    # TOC и spine
-    toc = []
-    spine = []
-    # if cover_page:
-    #     toc.append(cover_page)
-    #     spine.append(cover_page)
-    toc.append(meta_chapter)
-    toc.append(toc_chapter)
-    spine.append(meta_chapter)
-    spine.append(toc_chapter)
-    toc.extend(chapter_items)
-    spine.extend(chapter_items)
-
-    book.toc = toc
-    book.spine = [] + spine
-    book.add_item(epub.EpubNcx())
-    book.add_item(epub.EpubNav())
-
-    epub.write_epub(output_file, book)
-    print(f"Содержимое книги сохранено в {output_file}")
-
-
-def main():
-    story_url = "https://www.wattpad.com/story/400248520"
-    output_base = "wattpad_book"
+    waiting = deque(jobs)
+    active = deque()
+    while waiting or active:
+        while waiting and len(active) < max(1, max_active):
+            job = waiting.popleft()
+            job.start()
+            active.append((job, iter(job.plan)))
+        job, plan = active.popleft()
+        task = next(plan, None)
+        if task is None:
+            continue
+        active.append((job, plan))
+        i, chapter, stored_path = task
+        yield job, i, chapter, stored_path
+
+def open_writers(metadata, chapters, output_base, formats):
+    writers = [STREAMING_FORMATS[fmt](f"{output_base}.{fmt}", metadata, chapters)
+               for fmt in formats if fmt in STREAMING_FORMATS]
+    writers.append(BookWriter(f"{output_base}.book.jsonl", metadata, chapters))
+    return writers
+
+def report_failed_chapters(chapters, done):
+    failed = [(i, chapter) for i, chapter in enumerate(chapters) if i not in done]
+    if not failed:
+        log.info("Все главы загружены: %s", len(done))
+        return
+    log.warning("Не удалось загрузить глав: %s из %s", len(failed), len(chapters))
+    for i, chapter in failed:
+        log.warning("  %s. %s (%s)", i + 1, chapter['title'], chapter['url'])
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Скачивание истории с Wattpad в Markdown, TXT, PDF и EPUB")
+    parser.add_argument('story_url', nargs='?', default="https://www.wattpad.com/story/400248520")
+    parser.add_argument('--output', default="wattpad_book", help="Базовое имя выходных файлов")
+    parser.add_argument('--batch', help="Файл со ссылками на истории, списки чтения или профили (по одной в строке)")
+    parser.add_argument('--batch-dir', default="wattpad_books",
+                        help="Каталог пакетной загрузки; каждая история сохраняется в свой подкаталог")
+    parser.add_argument('--max-active-stories', type=int, default=MAX_WORKERS,
+                        help="Сколько историй пакета загружаются одновременно")
+    parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread',
+                        help="Движок загрузки глав (по умолчанию thread)")
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS, help="Число потоков движка thread")
+    parser.add_argument('--concurrency', type=int, default=ASYNC_CONCURRENCY,
+                        help="Общий лимит одновременных запросов движка asyncio")
+    parser.add_argument('--per-host', type=int, default=ASYNC_PER_HOST,
+                        help="Лимит одновременных запросов к одному хосту для движка asyncio")
+    parser.add_argument('--source', choices=['html', 'api'], default='html',
+                        help="Источник истории и глав: HTML-страницы или JSON API Wattpad с откатом на HTML")
+    parser.add_argument('--parser', choices=['html.parser', 'lxml'], default='html.parser',
+                        help="Парсер HTML (по умолчанию html.parser; lxml быстрее, но на части разметки "
+                             "расходится с ним, см. wattpad-bench.py parsers)")
+    parser.add_argument('--parse-processes', type=int, default=0,
+                        help="Число процессов для разбора глав (0 — разбор в потоках загрузки)")
+    parser.add_argument('--image-workers', type=int, default=MAX_WORKERS,
+                        help="Число потоков загрузки изображений")
+    parser.add_argument('--image-max-size', type=int,
+                        help="Уменьшать изображения до этого размера по большей стороне (нужен Pillow)")
+    parser.add_argument('--image-quality', type=int,
+                        help="Пережимать изображения в JPEG с этим качеством, 1-95 (нужен Pillow)")
+    parser.add_argument('--window', type=int,
+                        help="Сколько глав может быть в работе одновременно (окно упорядочивания)")
+    parser.add_argument('--rate', type=float, default=RATE_LIMIT,
+                        help="Максимум запросов в секунду (по умолчанию 0 — без ограничения, темп подстраивается по ответам 429/503)")
+    parser.add_argument('--cache-dir', help="Каталог дискового кеша HTTP-ответов (по умолчанию кеш выключен)")
+    parser.add_argument('--max-cache-mb', type=float, default=CACHE_MAX_MB, help="Максимальный размер кеша в МБ")
+    parser.add_argument('--sync', action='store_true',
+                        help="Обновить книгу: новые и изменённые главы загружаются, неизменённые берутся из хранилища "
+                             "(изменения видны по оглавлению --source api, иначе главы перепроверяются, с --cache-dir — условно)")
+    parser.add_argument('--resume', action='store_true',
+                        help="Продолжить прерванную загрузку: готовые главы и изображения берутся из хранилища и журнала")
+    parser.add_argument('--formats', default=','.join(EXPORT_FORMATS),
+                        help="Выходные форматы через запятую (по умолчанию md,txt,pdf,epub)")
+    parser.add_argument('--export-processes', type=int, default=2,
+                        help="Число процессов для сборки PDF (0 — сборка в потоке загрузки)")
+    parser.add_argument('--pdf-chunk-chapters', type=int, default=PDF_CHUNK_CHAPTERS,
+                        help="Сколько глав верстается в одной части PDF перед склейкой (нужен pypdf)")
+    parser.add_argument('--pdf-processes', type=int, default=1,
+                        help="Число процессов для вёрстки частей PDF")
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO',
+                        help="Уровень подробности журнала (DEBUG — разбор каждого абзаца)")
+    parser.add_argument('--report', help="Записать JSON-отчёт о запуске: итоги историй, время стадий, счётчики")
+    parser.add_argument('--metrics-file',
+                        help="Файл метрик в текстовом формате Prometheus, обновляется во время работы")
+    parser.add_argument('--from-book',
+                        help="Собрать форматы заново из сохранённого файла <output>.book.jsonl без загрузки")
+    args = parser.parse_args(argv)
+    args.formats = [fmt.strip() for fmt in args.formats.split(',') if fmt.strip()]
+    unknown = [fmt for fmt in args.formats if fmt not in EXPORT_FORMATS]
+    if unknown or not args.formats:
+        parser.error(f"неизвестные форматы: {', '.join(unknown)}; доступны {', '.join(EXPORT_FORMATS)}")
+    return args
+
+def read_story_urls(path):
+    """Читает файл со ссылками на истории; списки чтения и профили раскрываются в истории."""
+    urls = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if re.search(r'/story/\d+', line):
+                urls.append(line)
+            else:
+                urls.extend(expand_story_list(line))
+    # Одна история может встретиться в нескольких списках
+    unique = {}
+    for url in urls:
+        unique.setdefault(re.search(r'/story/(\d+)', url).group(1), url)
+    return list(unique.values())
+
+def expand_story_list(url):
+    html_content = get_page_content(url)
+    if not html_content:
+        log.error("Не удалось загрузить список историй %s", url)
+        return []
+    return [urllib.parse.urljoin(url, href) for href in re.findall(r'href="([^"]*/story/\d+[^"]*)"', html_content)]
+
+def story_output_base(batch_dir, story_url, basename):
+    slug = urllib.parse.urlparse(story_url).path.rstrip('/').rsplit('/', 1)[-1]
+    slug = re.sub(r'[^\w.-]', '_', slug) or 'story'
+    return os.path.join(batch_dir, slug, basename)
+
+def prepare_story(story_url, output_base, args):
+    """Загружает страницу истории и строит план глав; None, если страница недоступна."""
     output_dir = os.path.dirname(output_base) or "."
+    os.makedirs(output_dir, exist_ok=True)
     
     # Для авторизации (если требуется)
     cookies = None  # Замените на {'session_id': 'your_session_id', ...} при необходимости
-    html_content = get_page_content(story_url, cookies=cookies)
-    if not html_content:
-        print("Ошибка: Не удалось загрузить главную страницу. Проверьте URL или добавьте cookies для авторизации.")
-        return
+    story = fetch_story_api(story_url, cookies=cookies) if args.source == 'api' else None
+    if args.source == 'api' and not story:
+        metrics.count('api_fallbacks')
+        log.warning("История %s не получена через API, загружается HTML-страница", story_url)
+    story = story or fetch_story_html(story_url, cookies=cookies)
+    if not story:
+        log.error("Не удалось загрузить главную страницу %s. Проверьте URL или добавьте cookies для авторизации.", story_url)
+        return None
     
-    soup = BeautifulSoup(html_content, 'html.parser')
-    metadata = parse_story_metadata(soup, output_dir)
+    metadata, chapters = story
+    # Признаки изменения глав для --sync: лёгкий запрос оглавления API вместо перепроверки каждой главы
+    versioned = args.source == 'api' or apply_api_versions(story_url, chapters, cookies=cookies)
+    metadata['cover_path'] = download_image(metadata['cover_url'], output_dir, "cover.jpg") if metadata['cover_url'] else None
     
-    print(f"Название: {metadata['title']}")
-    print(f"Автор: {metadata['author']}")
-    print(f"Описание: {metadata['description']}")
-    print(f"Теги: {metadata['tags']}")
-    print(f"Статистика: Просмотры={metadata['stats']['views']}, Голоса={metadata['stats']['votes']}, Главы={metadata['stats']['chapters']}")
+    log.info("Название: %s", metadata['title'])
+    log.info("Автор: %s", metadata['author'])
+    log.info("Описание: %s", metadata['description'])
+    log.info("Теги: %s", metadata['tags'])
+    log.info("Статистика: Просмотры=%s, Голоса=%s, Главы=%s", metadata['stats']['views'], metadata['stats']['votes'], metadata['stats']['chapters'])
     
-    chapters = parse_chapter_list(soup)
-    print(f"Найдено глав: {len(chapters)}")
+    log.info("Найдено глав: %s", len(chapters))
     metadata['stats']['chapters'] = len(chapters)
     
-    chapters_data = []
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        future_to_chapter = {executor.submit(process_chapter, chapter, i, output_dir): i for i, chapter in enumerate(chapters)}
-        for future in future_to_chapter:
-            result = future.result()
-            if result:
-                chapters_data.append(result)
+    manifest = load_manifest(output_base)
+    if args.sync or args.resume:
+        plan = plan_sync(chapters, manifest, output_base, revalidate=not args.resume)
+        stored = sum(1 for _, _, stored_path in plan if stored_path)
+        if args.resume:
+            log.info("Продолжение загрузки: осталось глав %s, готово %s", len(plan) - stored, stored)
+        else:
+            log.info("Синхронизация: загружаются или перепроверяются глав %s, без изменений %s", len(plan) - stored, stored)
+            if stored < len(plan) and not versioned and not args.cache_dir:
+                log.info("Оглавление API недоступно, главы перепроверяются полной загрузкой; "
+                         "с --cache-dir неизменённые страницы вернутся ответом 304")
+    else:
+        plan = [(i, chapter, None) for i, chapter in enumerate(chapters)]
+    image_options = {'max_size': args.image_max_size, 'quality': args.image_quality}
+    return StoryJob(story_url, output_base, metadata, chapters, plan, manifest, image_options, args.formats,
+                    resume=args.sync or args.resume)
+
+def export_saved_book(book_file, formats):
+    """Пересобирает выбранные форматы из промежуточного представления, без сети."""
+    suffix = '.book.jsonl'
+    output_base = book_file[:-len(suffix)] if book_file.endswith(suffix) else os.path.splitext(book_file)[0]
+    exports = [(fmt, f"{output_base}.{fmt}", submit_export(book_file, fmt, f"{output_base}.{fmt}")) for fmt in formats]
+    return wait_exports(exports)
+
+def write_metrics_file(path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(metrics.prometheus())
+    os.replace(tmp_path, path)
+
+def start_metrics_file(path, interval=METRICS_INTERVAL):
+    """Обновляет файл метрик каждые interval секунд (например, для textfile collector node_exporter)."""
+    stop = threading.Event()
+
+    def update():
+        while not stop.wait(interval):
+            write_metrics_file(path)
+
+    threading.Thread(target=update, daemon=True).start()
+    return stop
+
+def log_run_summary(elapsed):
+    snapshot = metrics.snapshot()
+    counters = snapshot['counters']
+    hit_rate = snapshot['cache_hit_rate']
+    log.info("Запросов: %s, получено %.1f МБ, повторов: %s, попаданий в кеш: %s",
+             counters.get('http_requests', 0), counters.get('http_bytes', 0) / 1024 / 1024,
+             counters.get('http_retries', 0), f"{hit_rate:.0%}" if hit_rate is not None else "—")
+    # Время стадий суммируется по всем потокам, поэтому может превышать общее время
+    stages = ", ".join(f"{stage} {stats['seconds']:.1f} с" for stage, stats in sorted(snapshot['stages'].items()))
+    log.info("Общее время: %.1f с; время стадий: %s", elapsed, stages or "нет")
+
+def finish_run(args, started, jobs, metrics_updater=None):
+    elapsed = time.time() - started
+    log_run_summary(elapsed)
+    if args.report:
+        write_json_atomic(args.report, {
+            'started_at': started,
+            'elapsed': elapsed,
+            'engine': args.engine,
+            'stories': [job.summary() for job in jobs],
+            'metrics': metrics.snapshot(),
+        })
+        log.info("Отчёт о запуске сохранён в %s", args.report)
+    if args.metrics_file:
+        metrics_updater.set()
+        write_metrics_file(args.metrics_file)
+
+def download_stories(args):
+    configure_session(pool_size=args.workers + args.image_workers)
+    configure_parser(args.parser)
+    configure_cache(args.cache_dir, args.max_cache_mb)
+    configure_rate_limit(args.rate, args.concurrency if args.engine == 'asyncio' else args.workers + args.image_workers)
     
-    # Сортировка chapters_data по индексу
-    chapters_data.sort(key=lambda x: x['index'])
+    if args.batch:
+        basename = os.path.basename(args.output)
+        targets = [(url, story_output_base(args.batch_dir, url, basename)) for url in read_story_urls(args.batch)]
+        log.info("Историй в пакете: %s", len(targets))
+    else:
+        targets = [(args.story_url, args.output)]
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        jobs = [job for job in executor.map(lambda target: prepare_story(*target, args), targets) if job]
     
-    save_to_markdown(metadata, chapters_data, f"{output_base}.md")
-    save_to_txt(metadata, chapters_data, f"{output_base}.txt")
-    save_to_pdf(metadata, chapters_data, f"{output_base}.pdf")
-    save_to_epub(metadata, chapters_data, f"{output_base}.epub")
+    configure_parse_pool(args.parse_processes, args.parser)
+    configure_image_pool(args.image_workers)
+    configure_page_pool(args.workers)
+    configure_export_pool(args.export_processes, args.pdf_chunk_chapters, args.pdf_processes)
+    tasks = schedule_stories(jobs, args.max_active_stories)
+    if args.engine == 'asyncio':
+        download_chapters_async(tasks, args.concurrency, args.per_host, args.window)
+    else:
+        # Потоки, ждущие разбора в пуле процессов, не занимают слоты сетевых запросов
+        download_chapters_threaded(tasks, args.workers + args.parse_processes, args.window)
+    configure_parse_pool(0)
+    configure_image_pool(0)
+    configure_page_pool(0)
+    export_failures = sum(wait_exports(job.exports) for job in jobs)
+    configure_export_pool(0)
+    if args.batch:
+        log.info("Пакет завершён: загружено историй %s из %s", len(jobs), len(targets))
+    return jobs, export_failures
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=getattr(logging, args.log_level), format="%(asctime)s %(levelname)s %(message)s",
+                        datefmt="%H:%M:%S")
+    started = time.time()
+    metrics_updater = start_metrics_file(args.metrics_file) if args.metrics_file else None
+    jobs = []
+    if args.from_book:
+        configure_export_pool(min(args.export_processes, len(args.formats)), args.pdf_chunk_chapters, args.pdf_processes)
+        export_failures = export_saved_book(args.from_book, args.formats)
+        configure_export_pool(0)
+    else:
+        jobs, export_failures = download_stories(args)
+    finish_run(args, started, jobs, metrics_updater)
+    if export_failures:
+        log.error("Не удалось экспортировать файлов: %s", export_failures)
+        return 1
+    return 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())